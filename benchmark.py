@@ -0,0 +1,431 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of the bot: simulated users talk to the real handlers, Telegram is
+# replaced by a fake answering in-process and OpenAI by a local HTTP stub, so no tokens
+# are used. Reports throughput, latency percentiles, Telegram calls, file I/O and memory.
+#
+# python3 benchmark.py --users 50 --messages 10 --latency 0.5 --token-delay 0.01
+# python3 benchmark.py --json result.json
+# python3 benchmark.py --baseline result.json --tolerance 0.2   (exit code 1 on a regression)
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import resource
+import tracemalloc
+from collections import Counter
+import openai
+from aiohttp import web
+from telegram import Update
+from telegram.request import BaseRequest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import chatgpt_bot
+
+MODELS = ["gpt-3.5-turbo", "gpt-4"]
+TINY_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+HANDLER_TIMEOUT = 120
+
+# -------------------------------------------------------------------------------------
+
+class OpenAIStub:
+    # local HTTP server speaking enough of the OpenAI API for the bot, with a
+    # configurable delay before the answer and between the streamed tokens
+    def __init__(self, latency: float, jitter: float, token_delay: float, reply_tokens: int) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.requests = Counter()
+        self.prompt_chars = 0 # of all chat requests
+        self.runner = None
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/images/generations", self.images)
+        app.router.add_post("/v1/audio/transcriptions", self.transcription)
+        app.router.add_get("/v1/models", self.models)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return "http://127.0.0.1:{}/v1".format(port)
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+    async def _wait(self) -> None:
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def _tokens(self, prompt: str):
+        return ["{} ".format(word) for word in (prompt.split() or ["answer"]) * self.reply_tokens][:self.reply_tokens]
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests["chat"] += 1
+        self.prompt_chars += sum(len(message['content']) for message in body['messages'])
+        tokens = self._tokens(body['messages'][-1]['content'])
+        await self._wait()
+        if not body.get('stream'):
+            return web.json_response({"id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body['model'],
+                                      "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(tokens)}}],
+                                      "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": body['model'],
+                     "choices": [{"index": 0, "finish_reason": None, "delta": {"content": token}}]}
+            await response.write("data: {}\n\n".format(json.dumps(chunk)).encode())
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests["image"] += 1
+        await self._wait()
+        if body.get('response_format') == "b64_json":
+            image = {"b64_json": TINY_PNG}
+        else:
+            image = {"url": "https://example.com/bench.png"}
+        return web.json_response({"created": int(time.time()), "data": [image] * body.get('n', 1)})
+
+    async def transcription(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.requests["audio"] += 1
+        await self._wait()
+        return web.json_response({"text": "transcribed voice message"})
+
+    async def models(self, request: web.Request) -> web.Response:
+        self.requests["models"] += 1
+        return web.json_response({"object": "list", "data": [{"id": model, "object": "model"} for model in MODELS]})
+
+# -------------------------------------------------------------------------------------
+
+class FakeTelegram(BaseRequest):
+    # answers the Bot API calls in-process, optionally after latency seconds
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = 0
+        self.me = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, parameters: dict, **content) -> dict:
+        self.message_ids += 1
+        message = {"message_id": parameters.get('message_id', self.message_ids), "date": int(time.time()), "from": self.me,
+                   "chat": {"id": int(parameters.get('chat_id', 0)), "type": "private"}}
+        message.update(content)
+        return message
+
+    def _photo(self) -> list:
+        self.message_ids += 1
+        return [{"file_id": "photo{}".format(self.message_ids), "file_unique_id": "unique{}".format(self.message_ids), "width": 1024, "height": 1024}]
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = self.me
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(parameters, text=parameters.get('text', ""))
+        elif endpoint == "sendPhoto":
+            result = self._message(parameters, photo=self._photo())
+        elif endpoint == "sendMediaGroup":
+            media = parameters.get('media', [])
+            if isinstance(media, str):
+                media = json.loads(media)
+            result = [self._message(parameters, photo=self._photo()) for photo in media]
+        elif endpoint == "getFile":
+            result = {"file_id": parameters.get('file_id'), "file_unique_id": parameters.get('file_id'), "file_size": 1000, "file_path": "voice.ogg"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# -------------------------------------------------------------------------------------
+
+def measured(name: str):
+    # runs the handler of ChatGPTBot and tells the waiting simulated user when it is done,
+    # chat messages are done when the chat worker of the user has answered them
+    async def handler(self, update: Update, context):
+        try:
+            return await getattr(chatgpt_bot.ChatGPTBot, name)(self, update, context)
+        finally:
+            if str(update.effective_user.id) not in self.chat_queues:
+                self.done(update.effective_user.id)
+    return handler
+
+class BenchmarkBot(chatgpt_bot.ChatGPTBot):
+    topic = measured("topic")
+    newtopic = measured("newtopic")
+    newtopicname = measured("newtopicname")
+    chat_query = measured("chat_query")
+    chat_voice = measured("chat_voice")
+    image = measured("image")
+    create_image = measured("create_image")
+    compare = measured("compare")
+    compare_query = measured("compare_query")
+
+    def __init__(self, *args) -> None:
+        self.waiting = {} # telegram user id -> future resolved when the handler returns
+        super().__init__(*args)
+
+    async def _chatWorker(self, user, queue) -> None:
+        try:
+            await super()._chatWorker(user, queue)
+        finally:
+            self.done(int(user.id))
+
+    def done(self, user_id: int) -> None:
+        future = self.waiting.pop(user_id, None)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+# -------------------------------------------------------------------------------------
+
+class Benchmark:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.latencies = {} # kind -> list of seconds
+        self.errors = 0
+        self.update_ids = 0
+
+    def _writeConfig(self) -> None:
+        users = ["{}#bench{}#en".format(1000 + index, index) for index in range(self.args.users)]
+        config = {"openai_key": "bench", "telegram_token": "1:bench", "max_history_entries": self.args.history, "models": MODELS,
+                  "current_model": MODELS[0], "max_concurrent_requests": self.args.concurrency, "stream_responses": not self.args.no_stream,
+                  "stream_edit_interval": self.args.edit_interval, "storage": self.args.storage, "image_count": self.args.image_count,
+                  "summary": {"enabled": self.args.summary_threshold > 0, "threshold": self.args.summary_threshold},
+                  "storage_flush_interval": self.args.flush_interval,
+                  "coalesce_window": self.args.coalesce_window, "users": users}
+        with open("config.json", "w", encoding='utf-8') as configFile:
+            configFile.write(json.dumps(config, indent=4))
+        shutil.copy(os.path.join(BASE_DIR, "translations.json"), "translations.json")
+
+    def _update(self, bot: BenchmarkBot, user_id: int, text: str, voice: str = None) -> Update:
+        self.update_ids += 1
+        message = {"message_id": self.update_ids, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": "bench"}}
+        if voice:
+            message['voice'] = {"file_id": voice, "file_unique_id": voice, "duration": 3, "mime_type": "audio/ogg", "file_size": 1000}
+        else:
+            message['text'] = text
+        if text.startswith("/"):
+            message['entities'] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self.update_ids, "message": message}, bot.updater.bot)
+
+    async def _send(self, bot: BenchmarkBot, user_id: int, text: str, kind: str = None, voice: str = None, burst: int = 1) -> None:
+        # puts the message into the update queue like the webhook does and waits for the handler,
+        # a burst are several messages sent at once
+        future = asyncio.get_running_loop().create_future()
+        bot.waiting[user_id] = future
+        start = time.perf_counter()
+        for message in range(burst):
+            await bot.updater.update_queue.put(self._update(bot, user_id, "{} ({})".format(text, message + 1) if burst > 1 else text, voice))
+        try:
+            await asyncio.wait_for(future, HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            bot.waiting.pop(user_id, None)
+            self.errors += 1
+            return
+        if kind:
+            self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def _user(self, bot: BenchmarkBot, index: int) -> None:
+        user_id = 1000 + index
+        await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+        await self._send(bot, user_id, "/topic")
+        await self._send(bot, user_id, bot.lang.trans("newTopic", "en"))
+        await self._send(bot, user_id, "topic{}".format(index), "topic")
+        await self._send(bot, user_id, "/chat")
+        for message in range(self.args.messages):
+            if self.args.burst > 1:
+                await self._send(bot, user_id, "question {} of user {} about something".format(message, index), "burst", burst=self.args.burst)
+            else:
+                await self._send(bot, user_id, "question {} of user {} about something".format(message, index), "chat")
+            if self.args.think_time:
+                await asyncio.sleep(random.expovariate(1 / self.args.think_time))
+        for voice in range(self.args.voices):
+            await self._send(bot, user_id, "", "voice", "voice{}_{}".format(index, voice))
+        await self._send(bot, user_id, "/cancel")
+        for image in range(self.args.images):
+            await self._send(bot, user_id, "/image")
+            await self._send(bot, user_id, "a picture of benchmark {}".format(image), "image")
+        for compare in range(self.args.compares):
+            await self._send(bot, user_id, "/compare")
+            await self._send(bot, user_id, "compare question {} of user {}".format(compare, index), "compare")
+
+    async def run(self) -> dict:
+        stub = OpenAIStub(self.args.latency, self.args.jitter, self.args.token_delay, self.args.reply_tokens)
+        openai.api_base = await stub.start()
+        self._writeConfig()
+        config = chatgpt_bot.Config()
+        bot = BenchmarkBot(config, chatgpt_bot.OpenaAI_API(config), chatgpt_bot.Translations())
+        telegram = FakeTelegram(self.args.telegram_latency)
+        bot.updater.bot._request = (telegram, telegram)
+        await bot.updater.initialize()
+        await bot._postInit(bot.updater)
+        await bot.updater.start()
+
+        io_before = readProcIO()
+        opens = Counter()
+        chats = os.path.abspath("chats")
+        def audit(event, event_args):
+            if event == "open" and isinstance(event_args[0], str) and os.path.abspath(event_args[0]).startswith(chats):
+                mode = event_args[1] if isinstance(event_args[1], str) else ""
+                opens["write" if set(mode) & set("wax+") else "read"] += 1
+        sys.addaudithook(audit)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.args.trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(self._user(bot, index) for index in range(self.args.users)))
+        wall = time.perf_counter() - start
+
+        memory = {"rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before}
+        if self.args.trace_memory:
+            memory['traced_current_kb'], memory['traced_peak_kb'] = (size // 1024 for size in tracemalloc.get_traced_memory())
+            tracemalloc.stop()
+        await bot.updater.stop()
+        await bot._postShutdown(bot.updater)
+        await bot.updater.shutdown()
+        await stub.stop()
+        io_after = readProcIO()
+        opens = dict(opens) # the audit hook stays installed, stop counting here
+
+        measured_count = sum(len(values) for values in self.latencies.values())
+        result = {"users": self.args.users, "messages": measured_count, "errors": self.errors, "wall_seconds": wall,
+                  "throughput": measured_count / wall if wall else 0.0, "latency": {}, "memory": memory,
+                  "telegram_calls_per_message": {endpoint: count / max(measured_count, 1) for endpoint, count in sorted(telegram.calls.items())},
+                  "openai_requests": dict(stub.requests),
+                  "prompt_chars_per_chat_request": stub.prompt_chars / max(stub.requests["chat"], 1),
+                  "file_opens_per_message": {mode: count / max(measured_count, 1) for mode, count in sorted(opens.items())}}
+        for kind, values in sorted(self.latencies.items()):
+            values.sort()
+            result['latency'][kind] = {"n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                                       "p99": percentile(values, 99), "max": values[-1]}
+        if io_before and io_after:
+            result['disk_bytes_written_per_message'] = (io_after['write_bytes'] - io_before['write_bytes']) / max(measured_count, 1)
+        return result
+
+# -------------------------------------------------------------------------------------
+
+def percentile(values: list, p: float) -> float:
+    # nearest rank of the sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+def readProcIO():
+    # bytes the process caused to be written to the disk (Linux only)
+    try:
+        with open("/proc/self/io") as ioFile:
+            return {key: int(value) for key, value in (line.split(": ") for line in ioFile)}
+    except OSError:
+        return None
+
+def printResult(result: dict) -> None:
+    print("users {}, measured messages {}, errors {}, wall {:.2f}s, throughput {:.1f} msg/s".format(
+        result['users'], result['messages'], result['errors'], result['wall_seconds'], result['throughput']))
+    print("{:<8}{:>7}{:>9}{:>9}{:>9}{:>9}".format("latency", "n", "p50", "p95", "p99", "max"))
+    for kind, latency in result['latency'].items():
+        print("{:<8}{:>7}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}".format(kind, latency['n'], latency['p50'], latency['p95'], latency['p99'], latency['max']))
+    print("telegram calls/message: {}".format(", ".join("{} {:.2f}".format(key, value) for key, value in result['telegram_calls_per_message'].items())))
+    print("openai requests: {}".format(", ".join("{} {}".format(key, value) for key, value in result['openai_requests'].items())))
+    print("prompt characters/chat request: {:.0f}".format(result['prompt_chars_per_chat_request']))
+    print("file opens/message: {}".format(", ".join("{} {:.2f}".format(key, value) for key, value in result['file_opens_per_message'].items()) or "-"))
+    if 'disk_bytes_written_per_message' in result:
+        print("disk bytes written/message: {:.0f}".format(result['disk_bytes_written_per_message']))
+    print("memory: {}".format(", ".join("{} {}".format(key, value) for key, value in result['memory'].items())))
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    # regressions against an earlier run with the same arguments
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append("throughput {:.1f} < {:.1f}".format(result['throughput'], baseline['throughput']))
+    for kind, latency in result['latency'].items():
+        before = baseline['latency'].get(kind)
+        if before and latency['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append("{} p95 {:.3f}s > {:.3f}s".format(kind, latency['p95'], before['p95']))
+    return regressions
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot with a fake Telegram and a local OpenAI stub")
+    parser.add_argument("--users", type=int, default=20, help="simulated users talking at the same time")
+    parser.add_argument("--messages", type=int, default=10, help="chat messages per user")
+    parser.add_argument("--images", type=int, default=1, help="image requests per user")
+    parser.add_argument("--compares", type=int, default=0, help="questions per user sent to all models with /compare")
+    parser.add_argument("--voices", type=int, default=1, help="voice messages per user")
+    parser.add_argument("--burst", type=int, default=1, help="chat messages a user sends at once instead of a single one")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="coalesce_window of the bot")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause of a user between two messages in seconds")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="the users start within this many seconds")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds until OpenAI starts answering")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random +- seconds added to the latency")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between two streamed tokens")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="tokens per answer")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Telegram API call")
+    parser.add_argument("--no-stream", action="store_true", help="answer in one message instead of streaming")
+    parser.add_argument("--edit-interval", type=float, default=1.0, help="stream_edit_interval of the bot")
+    parser.add_argument("--concurrency", type=int, default=8, help="max_concurrent_requests of the bot")
+    parser.add_argument("--image-count", type=int, default=1, help="image_count of the bot")
+    parser.add_argument("--history", type=int, default=10, help="max_history_entries of the bot")
+    parser.add_argument("--summary-threshold", type=int, default=0, help="summary threshold of the bot in tokens, 0 disables summaries")
+    parser.add_argument("--storage", default="json", choices=["json", "journal", "sqlite"], help="storage backend of the bot")
+    parser.add_argument("--flush-interval", type=float, default=2.0, help="storage_flush_interval of the bot, 0 saves at once")
+    parser.add_argument("--trace-memory", action="store_true", help="also measure the python allocations (slows the run down)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the result into this file")
+    parser.add_argument("--baseline", help="result file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression against the baseline")
+    return parser.parse_args()
+
+# -------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    args = parseArguments()
+    random.seed(args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baselineFile:
+            baseline = json.load(baselineFile)
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="chatgpt_bot_benchmark_")
+    os.chdir(workdir)
+    try:
+        result = asyncio.run(Benchmark(args).run())
+    finally:
+        os.chdir(BASE_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    printResult(result)
+    if output:
+        with open(output, "w", encoding='utf-8') as resultFile:
+            resultFile.write(json.dumps(result, indent=4))
+    if baseline:
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        if regressions:
+            sys.exit(1)
@@ -3,64 +3,884 @@
 
 # pip3 install openai python-telegram-bot
 
+import io
 import os
+import re
+import base64
+import ssl
 import sys
 import json
+import signal
+import time
+import asyncio
+import sqlite3
+import threading
+import random
+import hashlib
+import functools
+import contextlib
+from collections import deque, OrderedDict
 import openai
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, error
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+try:
+    import redis
+    import redis.asyncio
+except ImportError:
+    redis = None
+from telegram import Update, InputMediaPhoto, ReplyKeyboardMarkup, ReplyKeyboardRemove, error
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     ContextTypes,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ConversationHandler,
     filters
 )
 
+# Telegram rejects longer messages
+MESSAGE_LIMIT = 4096
+STREAM_PLACEHOLDER = "…"
+# instruction for compressing the older turns of a topic into a summary
+SUMMARY_PROMPT = ("Summarize the following conversation between a user and an assistant for the assistant. Keep all facts, "
+                  "names, numbers and decisions that may be needed to continue it. Answer with the summary only.")
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+# sizes DALL-E can generate, and at most images per request (also the limit of a media group)
+IMAGE_SIZES = ("256x256", "512x512", "1024x1024")
+MAX_IMAGES = 10
+# number of sent replies remembered to avoid duplicates
+SENT_REPLIES_KEPT = 1000
+# seconds a request may wait for the rate limits before the user is told
+QUEUE_NOTICE_DELAY = 1.0
+# seconds after which the lock of a user held by a crashed bot process expires
+LOCK_TIMEOUT = 300
+# marks an update passed on by another webhook worker, it is never passed on again
+FORWARDED_HEADER = "X-ChatGPT-Bot-Forwarded"
+FORWARD_TIMEOUT = 10
+# Telegram lets bots download files up to 20 MB, below the 25 MB accepted by Whisper
+VOICE_SIZE_LIMIT = 20 * 1024 * 1024
+TRANSCRIPTS_KEPT = 1000
+# errors of a storage backend, the changes are written again with the next flush
+STORAGE_ERRORS = (OSError, sqlite3.Error) + ((redis.RedisError,) if redis else ())
+# transient OpenAI errors which are worth another try
+OPENAI_RETRY_ERRORS = (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                       openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+# context window of the models, in tokens
+MODEL_TOKEN_LIMITS = {"gpt-3.5-turbo": 4096, "gpt-3.5-turbo-16k": 16384, "gpt-4": 8192, "gpt-4-32k": 32768}
+# every message costs a few tokens for its role and separators
+MESSAGE_TOKEN_OVERHEAD = 4
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def countTokens(text: str, model: str) -> int:
+    if tiktoken is None:
+        # rough estimate without the tokenizer (pip3 install tiktoken)
+        return len(text) // 4 + 1
+    return len(_encoding(model).encode(text))
+
+def historyMessage(role: str, content: str, model: str) -> dict:
+    # the token count is calculated once and stored with the message
+    return {"role": role, "content": content, "tokens": countTokens(content, model) + MESSAGE_TOKEN_OVERHEAD}
+
+def promptMessages(history) -> list:
+    return [{"role": message['role'], "content": message['content']} for message in history]
+
+def splitMessage(text: str) -> list:
+    # Telegram rejects longer messages than MESSAGE_LIMIT, they are cut at a line break if possible
+    parts = []
+    while len(text) > MESSAGE_LIMIT:
+        cut = text.rfind("\n", 0, MESSAGE_LIMIT) + 1
+        if cut == 0:
+            cut = MESSAGE_LIMIT
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+# -------------------------------------------------------------------------------------
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+class Metrics:
+    # counters, gauges and latency histograms, rendered in the Prometheus text format
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [cumulative counts per bucket, sum, count]
+        self.gauges = {} # name -> function returning the current value
+
+    def count(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name: str, function) -> None:
+        self.gauges[name] = function
+
+    def quantile(self, histogram, q: float) -> float:
+        # upper bound of the bucket holding the quantile
+        buckets, total, count = histogram
+        for bound, counted in zip(LATENCY_BUCKETS, buckets):
+            if counted >= q * count:
+                return bound
+        return float('inf')
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(set(name for name, labels in self.counters)):
+            lines.append("# TYPE {}_{} counter".format(self.prefix, name))
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append("{}_{}{} {}".format(self.prefix, name, _labels(labels), value))
+        for name in sorted(set(name for name, labels in self.histograms)):
+            lines.append("# TYPE {}_{} histogram".format(self.prefix, name))
+            for (histogram, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if histogram != name:
+                    continue
+                for bound, counted in zip(LATENCY_BUCKETS, buckets):
+                    lines.append("{}_{}_bucket{} {}".format(self.prefix, name, _labels(labels + (("le", bound),)), counted))
+                lines.append("{}_{}_bucket{} {}".format(self.prefix, name, _labels(labels + (("le", "+Inf"),)), count))
+                lines.append("{}_{}_sum{} {}".format(self.prefix, name, _labels(labels), total))
+                lines.append("{}_{}_count{} {}".format(self.prefix, name, _labels(labels), count))
+        for name, function in sorted(self.gauges.items()):
+            lines.append("# TYPE {}_{} gauge".format(self.prefix, name))
+            lines.append("{}_{} {}".format(self.prefix, name, function()))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        # short text version for the /stats command
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            buckets, total, count = histogram
+            lines.append("{}{}: n={} avg={:.3f}s p50<={}s p95<={}s p99<={}s".format(name, _labels(labels), count, total / count,
+                         self.quantile(histogram, 0.5), self.quantile(histogram, 0.95), self.quantile(histogram, 0.99)))
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append("{}{}: {}".format(name, _labels(labels), value))
+        for name, function in sorted(self.gauges.items()):
+            lines.append("{}: {}".format(name, function()))
+        return "\n".join(lines)
+
+metrics = Metrics("chatgpt_bot")
+
+# -------------------------------------------------------------------------------------
+
+class RetryPolicy:
+    # retries a call with jittered exponential backoff, at most attempts times and
+    # not longer than budget seconds in total
+    def __init__(self, name: str, attempts: int, base_delay: float, max_delay: float, budget: float) -> None:
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retries = 0
+
+    def delay(self, attempt: int, ex: Exception) -> float:
+        if isinstance(ex, error.RetryAfter):
+            return ex.retry_after # Telegram tells how long to wait
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, call, retry_on, no_retry=()):
+        # call is a function returning a new awaitable for every attempt
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except no_retry:
+                raise
+            except retry_on as ex:
+                attempt += 1
+                delay = self.delay(attempt - 1, ex)
+                if attempt >= self.attempts or time.monotonic() - start + delay > self.budget:
+                    raise
+                self.retries += 1
+                metrics.count("retries_total", target=self.name)
+                await asyncio.sleep(delay)
+
 # -------------------------------------------------------------------------------------
 
 class User:
-    def __init__(self, name: str, id: int, path: str, max_entries, lang: str) -> None:
+    def __init__(self, name: str, id: int, path: str, max_entries, lang: str, storage) -> None:
         self.name = name
         self.id = id
         self.path = path
         self.max_entries = max_entries
-        self.data = None
+        self.language = lang
+        self.storage = storage
+        self.changes = [] # not yet saved changes
+        self.version = 0 # version of the data in a shared storage
+        self._data = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    @property
+    def data(self):
+        # the user data is loaded on first access
+        if self._data is None:
+            self.storage.load(self)
+        return self._data
+
+    def load(self, data) -> None:
+        # histories are kept as deques of role messages, older files hold plain
+        # strings of alternating questions and answers
+        for topic in data['topics']:
+            history = deque()
+            for index, entry in enumerate(topic['history']):
+                if isinstance(entry, str):
+                    entry = historyMessage("user" if index % 2 == 0 else "assistant", entry, "gpt-3.5-turbo")
+                history.append(entry)
+            topic['history'] = history
+        self._data = data
+
+    def unload(self) -> None:
+        # the data is loaded again on next access
+        self._data = None
 
     def save(self) -> None:
-        with open(self.path, 'w') as outfile:
-                        json.dump(self.data, outfile, indent=4)
+        # changes holds only what was not handed to the storage yet
+        if self.changes:
+            self.storage.write(self, self.changes)
+            self.changes = []
+
+    def apply(self, change) -> None:
+        # all modifications of the user data go through here, the storage backends
+        # persist the changes instead of the whole data
+        op = change[0]
+        data = self.data
+        if op == "current_topic":
+            data['current_topic'] = change[1]
+        elif op == "add_topic":
+            data['topics'].append({"name": change[1], "history": deque()})
+        elif op == "delete_topic":
+            data['topics'] = [topic for topic in data['topics'] if topic['name'] != change[1]]
+        elif op == "append":
+            self.historyOfTopic(change[1]).extend(change[2])
+        elif op == "trim":
+            history = self.historyOfTopic(change[1])
+            for _ in range(change[2]):
+                history.popleft()
+        elif op == "model":
+            # the model of a topic, or of the user for the topic ""
+            if change[1] == "":
+                data['model'] = change[2]
+            for topic in data['topics']:
+                if topic['name'] == change[1]:
+                    topic['model'] = change[2]
+        elif op == "summary":
+            # the oldest entries are replaced by a summary of them
+            history = self.historyOfTopic(change[1])
+            for _ in range(change[2]):
+                history.popleft()
+            for topic in data['topics']:
+                if topic['name'] == change[1]:
+                    topic['summary'] = change[3]
+
+    def _change(self, *change) -> None:
+        self.apply(change)
+        self.changes.append(change)
     
     def lang(self) -> str:
-        return self.data['language']
+        return self.language
 
     def hasActiveTopic(self) -> bool:
         return not self.data['current_topic'] == ""
+
+    def setCurrentTopic(self, topic: str) -> None:
+        self._change("current_topic", topic)
     
     def topics(self):
         topics = []
         for topic in self.data['topics']:
             topics.append(topic['name'])
         return topics
+
+    def addTopic(self, topic: str) -> None:
+        self._change("add_topic", topic)
+
+    def deleteTopic(self, topic: str) -> None:
+        if self.data['current_topic'] == topic:
+            self.setCurrentTopic("")
+        self._change("delete_topic", topic)
     
     def historyOfTopic(self, topic: str):
         for my_topic in self.data['topics']:
             if my_topic['name'] == topic:
                 return my_topic['history']
-        return []
-    
-    def updateHistory(self, topic: str, history):
+        return deque()
+
+    def modelOf(self, topic: str, default: str) -> str:
+        # the model chosen for the topic, else the one chosen by the user, else default
+        for my_topic in self.data['topics']:
+            if my_topic['name'] == topic and my_topic.get('model'):
+                return my_topic['model']
+        return self.data.get('model') or default
+
+    def setModel(self, model: str, topic: str = "") -> None:
+        self._change("model", topic, model)
+
+    def summaryOfTopic(self, topic: str):
+        # history message summarizing the entries dropped from the history, or None
         for my_topic in self.data['topics']:
             if my_topic['name'] == topic:
-                while len(history) > self.max_entries:
-                    history.pop(0)
-                my_topic['history'] = history
+                return my_topic.get('summary')
+        return None
+
+    def summarizeHistory(self, topic: str, count: int, summary: dict) -> None:
+        self._change("summary", topic, count, summary)
+
+    def trimHistory(self, topic: str, max_tokens: int) -> None:
+        # drop the oldest question/answer pairs until the history fits into max_tokens
+        history = self.historyOfTopic(topic)
+        tokens = sum(message['tokens'] for message in history)
+        count = 0
+        while count < len(history) and tokens > max_tokens:
+            tokens -= history[count]['tokens']
+            count += 1
+            if count < len(history) and history[count]['role'] == "assistant":
+                tokens -= history[count]['tokens']
+                count += 1
+        if count:
+            self._change("trim", topic, count)
+    
+    def updateHistory(self, topic: str, messages) -> None:
+        overflow = len(self.historyOfTopic(topic)) + len(messages) - self.max_entries
+        if overflow > 0:
+            self._change("trim", topic, overflow)
+        self._change("append", topic, messages)
+
+# -------------------------------------------------------------------------------------
+
+def _dumpJSON(data) -> str:
+    return json.dumps(data, indent=4, default=list)
+
+def _writeJSON(path: str, text: str) -> None:
+    # write to a temporary file and replace the old one, a crash never leaves a half written file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as outfile:
+        outfile.write(text)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, path)
+
+def _readJSON(path: str):
+    if not os.path.exists(path):
+        return {"language": "en", "current_topic": "", "topics": []}
+    with open(path, encoding='utf-8-sig') as userdata:
+        return json.load(userdata)
+
+class Storage:
+    # A backend saves in two steps: prepare() takes what is needed from the user
+    # data and runs on the event loop, commit() does the I/O and runs in a thread.
+    # The bot always uses a backend through WriteBehind, which calls them.
+    # A shared backend is used by several bot processes at the same time.
+    shared = False
+
+    def rollback(self, user: User, payload) -> None:
+        # undoes what prepare() changed in memory when the payload could not be written
+        pass
+
+    def isCurrent(self, user: User) -> bool:
+        # False if another bot process changed the user data
+        return True
+
+class JSONStorage(Storage):
+    # one file per user (./chats/topics_<name>.json), rewritten on every save
+    def load(self, user: User) -> None:
+        user.load(_readJSON(user.path))
+
+    def prepare(self, user: User, changes):
+        return user.path, _dumpJSON(user.data)
+
+    def commit(self, payload) -> None:
+        _writeJSON(*payload)
+
+class JournalStorage(Storage):
+    # the json file is a snapshot, the changes since then are appended to the
+    # journal ./chats/topics_<name>.<generation>.journal. The journal is folded
+    # into a new snapshot once it has more than compact_after entries.
+    def __init__(self, compact_after: int) -> None:
+        self.compact_after = compact_after
+        self.generations = {}
+        self.journal_entries = {}
+
+    def _journalPath(self, user: User, generation: int) -> str:
+        return "{}.{}.journal".format(os.path.splitext(user.path)[0], generation)
+
+    def load(self, user: User) -> None:
+        data = _readJSON(user.path)
+        generation = data.pop('journal', 0)
+        user.load(data)
+        entries = 0
+        if os.path.exists(self._journalPath(user, generation)):
+            with open(self._journalPath(user, generation), encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+                        break # incomplete last line of a crashed write
+                    user.apply(change)
+                    entries += 1
+        # left over if the last compaction crashed before it was deleted
+        if os.path.exists(self._journalPath(user, generation - 1)):
+            os.remove(self._journalPath(user, generation - 1))
+        self.generations[user.name] = generation
+        self.journal_entries[user.name] = entries
+
+    def prepare(self, user: User, changes):
+        generation = self.generations[user.name]
+        entries = self.journal_entries[user.name]
+        journal_path = self._journalPath(user, generation)
+        lines = "".join(json.dumps(change) + "\n" for change in changes)
+        snapshot = None
+        self.journal_entries[user.name] = entries + len(changes)
+        # the data must not hold changes which are not saved yet, they would end up
+        # in the snapshot and again in the next journal
+        if self.journal_entries[user.name] > self.compact_after and not user.changes:
+            # the new snapshot holds the changes and names the next journal, so the
+            # old one is obsolete as soon as the snapshot is replaced
+            snapshot = _dumpJSON(dict(user.data, journal=generation + 1))
+            self.generations[user.name] = generation + 1
+            self.journal_entries[user.name] = 0
+        return user.path, journal_path, lines, snapshot, generation, entries
+
+    def commit(self, payload) -> None:
+        path, journal_path, lines, snapshot = payload[:4]
+        if snapshot is not None:
+            _writeJSON(path, snapshot)
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            return
+        with open(journal_path, 'ab', buffering=0) as journal:
+            size = journal.seek(0, os.SEEK_END)
+            data = lines.encode('utf-8')
+            try:
+                while data:
+                    data = data[journal.write(data):]
+                os.fsync(journal.fileno())
+            except OSError:
+                journal.truncate(size) # a half written line would end the journal on reload
+                raise
+
+    def rollback(self, user: User, payload) -> None:
+        # the next try goes to the journal the snapshot on disk names
+        self.generations[user.name], self.journal_entries[user.name] = payload[4:]
+
+class SQLiteStorage(Storage):
+    # all users in one database, every save is a single transaction
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, language TEXT, current_topic TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS topics (user TEXT, name TEXT, PRIMARY KEY (user, name))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT, topic TEXT, "
+                            "role TEXT, content TEXT, tokens INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS messages_topic ON messages (user, topic, id)")
+            # databases of older versions lack the later columns
+            for table, column in (("topics", "summary"), ("topics", "model"), ("users", "model")):
+                if column not in [info[1] for info in self.db.execute("PRAGMA table_info({})".format(table))]:
+                    self.db.execute("ALTER TABLE {} ADD COLUMN {} TEXT".format(table, column))
+
+    def load(self, user: User) -> None:
+        with self.lock:
+            row = self.db.execute("SELECT language, current_topic, model FROM users WHERE name = ?", (user.name,)).fetchone()
+            if row is None:
+                # first start with this backend, take over the json file if there is one
+                data = _readJSON(user.path)
+                user.load(data)
+                self._insert(user)
+                return
+            data = {"language": row[0], "current_topic": row[1], "model": row[2] or "", "topics": []}
+            for topic, summary, model in self.db.execute("SELECT name, summary, model FROM topics WHERE user = ? ORDER BY rowid", (user.name,)).fetchall():
+                history = [{"role": role, "content": content, "tokens": tokens} for role, content, tokens in self.db.execute(
+                    "SELECT role, content, tokens FROM messages WHERE user = ? AND topic = ? ORDER BY id", (user.name, topic))]
+                data['topics'].append({"name": topic, "history": history, "summary": json.loads(summary) if summary else None, "model": model or ""})
+        user.load(data)
+
+    def _insert(self, user: User) -> None:
+        with self.db:
+            self.db.execute("INSERT INTO users (name, language, current_topic, model) VALUES (?, ?, ?, ?)",
+                            (user.name, user.data['language'], user.data['current_topic'], user.data.get('model', "")))
+            for topic in user.data['topics']:
+                summary = topic.get('summary')
+                self.db.execute("INSERT INTO topics (user, name, summary, model) VALUES (?, ?, ?, ?)",
+                                (user.name, topic['name'], json.dumps(summary) if summary else None, topic.get('model', "")))
+                self._insertMessages(user.name, topic['name'], topic['history'])
+
+    def _insertMessages(self, name: str, topic: str, messages) -> None:
+        self.db.executemany("INSERT INTO messages (user, topic, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+                            [(name, topic, message['role'], message['content'], message['tokens']) for message in messages])
+
+    def prepare(self, user: User, changes):
+        return user.name, changes
+
+    def commit(self, payload) -> None:
+        name, changes = payload
+        with self.lock, self.db:
+            for change in changes:
+                op = change[0]
+                if op == "current_topic":
+                    self.db.execute("UPDATE users SET current_topic = ? WHERE name = ?", (change[1], name))
+                elif op == "add_topic":
+                    self.db.execute("INSERT OR IGNORE INTO topics (user, name) VALUES (?, ?)", (name, change[1]))
+                elif op == "delete_topic":
+                    self.db.execute("DELETE FROM topics WHERE user = ? AND name = ?", (name, change[1]))
+                    self.db.execute("DELETE FROM messages WHERE user = ? AND topic = ?", (name, change[1]))
+                elif op == "append":
+                    self._insertMessages(name, change[1], change[2])
+                elif op == "trim":
+                    self.db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE user = ? AND topic = ? "
+                                    "ORDER BY id LIMIT ?)", (name, change[1], change[2]))
+                elif op == "model":
+                    if change[1] == "":
+                        self.db.execute("UPDATE users SET model = ? WHERE name = ?", (change[2], name))
+                    self.db.execute("UPDATE topics SET model = ? WHERE user = ? AND name = ?", (change[2], name, change[1]))
+                elif op == "summary":
+                    self.db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE user = ? AND topic = ? "
+                                    "ORDER BY id LIMIT ?)", (name, change[1], change[2]))
+                    self.db.execute("UPDATE topics SET summary = ? WHERE user = ? AND name = ?", (json.dumps(change[3]), name, change[1]))
+
+class WriteBehind:
+    # Sits in front of a storage backend: saved users only get queued and a background
+    # task writes them in batches, every flush_interval seconds or as soon as
+    # flush_batch changes are waiting. With a flush_interval of 0 the bot flushes at the
+    # end of every user section instead. The disk I/O runs in a worker thread.
+    def __init__(self, storage: Storage, flush_interval: float, flush_batch: int) -> None:
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.pending = {} # user name -> (user, changes)
+        self.writing = set() # names of the users whose changes are being written
+        self.queue_depth = 0 # number of changes waiting
+        self.last_flush_seconds = 0.0
+        self.flush_lock = asyncio.Lock()
+        self.batch_full = asyncio.Event()
+        self.task = None
+        metrics.gauge("storage_queue_depth", lambda: self.queue_depth)
+
+    @property
+    def shared(self) -> bool:
+        return self.storage.shared
+
+    def load(self, user: User) -> None:
+        self.storage.load(user)
+
+    def isCurrent(self, user: User) -> bool:
+        return self.storage.isCurrent(user)
+
+    def write(self, user: User, changes) -> None:
+        if user.name in self.pending:
+            self.pending[user.name][1].extend(changes)
+        else:
+            self.pending[user.name] = (user, list(changes))
+        self.queue_depth += len(changes)
+        if self.queue_depth >= self.flush_batch:
+            self.batch_full.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self.flush_lock:
+            self.batch_full.clear()
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+            self.queue_depth = 0
+            start = time.perf_counter()
+            batch = [(user, changes, self.storage.prepare(user, changes)) for user, changes in pending.values()]
+            self.writing = set(pending)
+            try:
+                failed = await asyncio.to_thread(self._commit, batch)
+            finally:
+                self.writing = set()
+            for user, changes, payload in failed:
+                # written with the next flush, ahead of the changes queued meanwhile
+                self.storage.rollback(user, payload)
+                later = self.pending.pop(user.name, (user, []))[1]
+                self.pending[user.name] = (user, changes + later)
+                self.queue_depth += len(changes)
+            self.last_flush_seconds = time.perf_counter() - start
+            metrics.observe("storage_write_seconds", self.last_flush_seconds, mode="batch" if self.flush_interval > 0 else "direct")
+
+    def isSaving(self, user: User) -> bool:
+        # True while changes of the user are queued or being written
+        return user.name in self.pending or user.name in self.writing
+
+    def _commit(self, batch) -> list:
+        # returns the entries which could not be written, the other users are saved anyway
+        failed = []
+        for user, changes, payload in batch:
+            try:
+                self.storage.commit(payload)
+            except STORAGE_ERRORS as ex:
+                print("Could not save the user data: {}".format(ex))
+                metrics.count("storage_errors_total")
+                failed.append((user, changes, payload))
+        return failed
+
+    def start(self) -> None:
+        if self.flush_interval > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # write everything that is still queued
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+class RedisStorage(Storage):
+    # users in a redis server (or anything speaking its protocol), shared by all bot
+    # processes using it. A version counter per user tells them about changes of the others.
+    shared = True
+
+    def __init__(self, url: str, prefix: str) -> None:
+        self.db = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, name: str, *parts) -> str:
+        return ":".join((self.prefix, "user", name) + parts)
+
+    def load(self, user: User) -> None:
+        values = self.db.hgetall(self._key(user.name))
+        if not values:
+            # first start with this backend, take over the json file if there is one
+            user.load(_readJSON(user.path))
+            with self.db.pipeline() as pipe:
+                pipe.hset(self._key(user.name), mapping={"language": user.data['language'], "current_topic": user.data['current_topic'],
+                                                         "model": user.data.get('model', "")})
+                for topic in user.data['topics']:
+                    pipe.rpush(self._key(user.name, "topics"), topic['name'])
+                    if topic['history']:
+                        pipe.rpush(self._key(user.name, "history", topic['name']), *[json.dumps(message) for message in topic['history']])
+                    if topic.get('summary'):
+                        pipe.hset(self._key(user.name, "summaries"), topic['name'], json.dumps(topic['summary']))
+                    if topic.get('model'):
+                        pipe.hset(self._key(user.name, "models"), topic['name'], topic['model'])
+                pipe.incr(self._key(user.name, "version"))
+                user.version = pipe.execute()[-1]
+            return
+        user.version = int(self.db.get(self._key(user.name, "version")) or 0)
+        data = {"language": values['language'], "current_topic": values['current_topic'], "model": values.get('model', ""), "topics": []}
+        summaries = self.db.hgetall(self._key(user.name, "summaries"))
+        models = self.db.hgetall(self._key(user.name, "models"))
+        for topic in self.db.lrange(self._key(user.name, "topics"), 0, -1):
+            history = [json.loads(message) for message in self.db.lrange(self._key(user.name, "history", topic), 0, -1)]
+            summary = summaries.get(topic)
+            data['topics'].append({"name": topic, "history": history, "summary": json.loads(summary) if summary else None,
+                                   "model": models.get(topic, "")})
+        user.load(data)
+
+    def isCurrent(self, user: User) -> bool:
+        return int(self.db.get(self._key(user.name, "version")) or 0) == user.version
+
+    def prepare(self, user: User, changes):
+        user.version += 1 # our own commit does not make the data outdated
+        return user.name, changes
+
+    def rollback(self, user: User, payload) -> None:
+        user.version -= 1
+
+    def commit(self, payload) -> None:
+        name, changes = payload
+        with self.db.pipeline() as pipe:
+            for change in changes:
+                op = change[0]
+                if op == "current_topic":
+                    pipe.hset(self._key(name), "current_topic", change[1])
+                elif op == "add_topic":
+                    pipe.rpush(self._key(name, "topics"), change[1])
+                elif op == "delete_topic":
+                    pipe.lrem(self._key(name, "topics"), 0, change[1])
+                    pipe.delete(self._key(name, "history", change[1]))
+                    pipe.hdel(self._key(name, "summaries"), change[1])
+                    pipe.hdel(self._key(name, "models"), change[1])
+                elif op == "append":
+                    pipe.rpush(self._key(name, "history", change[1]), *[json.dumps(message) for message in change[2]])
+                elif op == "trim":
+                    pipe.ltrim(self._key(name, "history", change[1]), change[2], -1)
+                elif op == "model":
+                    if change[1] == "":
+                        pipe.hset(self._key(name), "model", change[2])
+                    else:
+                        pipe.hset(self._key(name, "models"), change[1], change[2])
+                elif op == "summary":
+                    pipe.ltrim(self._key(name, "history", change[1]), change[2], -1)
+                    pipe.hset(self._key(name, "summaries"), change[1], json.dumps(change[3]))
+            pipe.incr(self._key(name, "version"))
+            pipe.execute()
+
+def createStorage(backend: str, compact_after: int, redis_url: str, redis_prefix: str):
+    if backend == "journal":
+        return JournalStorage(compact_after)
+    if backend == "sqlite":
+        return SQLiteStorage('./chats/users.sqlite')
+    if backend == "redis":
+        return RedisStorage(redis_url, redis_prefix)
+    return JSONStorage()
+
+# -------------------------------------------------------------------------------------
+
+class MemoryState:
+    # conversation states and user locks within this process
+    def __init__(self) -> None:
+        self.states = {}
+        self.locks = {}
+
+    async def conversations(self, name: str) -> dict:
+        return dict(self.states.get(name, {}))
+
+    async def setConversation(self, name: str, key: tuple, state) -> None:
+        if state is None:
+            self.states.get(name, {}).pop(key, None)
+        else:
+            self.states.setdefault(name, {})[key] = state
+
+    def lock(self, name: str):
+        if name not in self.locks:
+            self.locks[name] = asyncio.Lock()
+        return self.locks[name]
+
+class RedisState:
+    # conversation states and user locks in a redis server, shared by all bot processes
+    def __init__(self, url: str, prefix: str) -> None:
+        self.db = redis.asyncio.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, name: str) -> str:
+        return "{}:conversation:{}".format(self.prefix, name)
+
+    async def conversations(self, name: str) -> dict:
+        states = await self.db.hgetall(self._key(name))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in states.items()}
+
+    async def setConversation(self, name: str, key: tuple, state) -> None:
+        if state is None:
+            await self.db.hdel(self._key(name), json.dumps(key))
+        else:
+            await self.db.hset(self._key(name), json.dumps(key), json.dumps(state))
+
+    def lock(self, name: str):
+        return self.db.lock("{}:lock:{}".format(self.prefix, name), timeout=LOCK_TIMEOUT)
+
+def createState(backend: str, redis_url: str, redis_prefix: str):
+    if backend == "redis":
+        return RedisState(redis_url, redis_prefix)
+    return MemoryState()
+
+class StatePersistence(BasePersistence):
+    # keeps the states of the conversation handlers in a MemoryState or RedisState,
+    # nothing else of python-telegram-bot is persisted
+    def __init__(self, state) -> None:
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+                         update_interval=1)
+        self.state = state
+
+    async def get_conversations(self, name: str) -> dict:
+        return await self.state.conversations(name)
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        await self.state.setConversation(name, key, new_state)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
 
 # -------------------------------------------------------------------------------------
 
 class Config:
     def __init__(self):
+        self.mtime = self._mtime()
         config = self._loadFile()
+        os.makedirs('./chats', exist_ok=True)
         self.openai_key = config['openai_key']
         self.telegram_token = config['telegram_token']
         self.max_history_entries = config['max_history_entries']
@@ -69,32 +889,102 @@ class Config:
             models.append(model)
         self.models = set(models)
         self.current_model = config['current_model']
-        self.users = []
-        for user in config['users']:
-            if user:
-                values = user.split("#")
-                path = './chats/topics_{}.json'.format(values[1])
-                user = User(values[1], values[0], path, self.max_history_entries * 2, values[2])
-                self.users.append(user)
-
-                # setup some filesystem operations
-                if not os.path.exists(path):
-                    json_data = {"language": "en", "current_topic": "", "topics": []}
-                    user.data = json_data
-                    with open(path, 'w') as outfile:
-                        json.dump(json_data, outfile)
-                else:
-                    userdata = open(path, encoding='utf-8-sig')
-                    json_data = json.load(userdata)
-                    user.data = json_data
+        self.max_concurrent_requests = config.get('max_concurrent_requests', 8)
+        self.max_concurrent_updates = max(config.get('max_concurrent_updates', 256), 1)
+        self.model_concurrency = config.get('model_concurrency', {})
+        self.stream_responses = config.get('stream_responses', True)
+        self.stream_edit_interval = config.get('stream_edit_interval', 1.0)
+        self.model_list_ttl = config.get('model_list_ttl', 3600)
+        self.response_cache = config.get('response_cache', {})
+        self.rate_limits = config.get('rate_limits', {})
+        self.webhook = config.get('webhook', {})
+        # without the token anyone reaching the port could send updates in the name of a user
+        if self.webhook.get('enabled', False) and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", self.webhook.get('secret_token', "")):
+            print("webhook needs a secret_token of 1 - 256 characters A-Z, a-z, 0-9, _ and -!")
+            sys.exit()
+        if self.webhook.get('workers') and not 0 <= self.webhook.get('worker', 0) < len(self.webhook['workers']):
+            print("webhook worker must be the index of this bot in webhook workers!")
+            sys.exit()
+        retry = config.get('retry', {})
+        retry_settings = (retry.get('attempts', 5), retry.get('base_delay', 0.5), retry.get('max_delay', 20), retry.get('budget', 60))
+        self.telegram_retry = RetryPolicy("telegram", *retry_settings)
+        self.openai_retry = RetryPolicy("openai", *retry_settings)
+        self.metrics = config.get('metrics', {})
+        self.admins = set(str(admin) for admin in config.get('admins', []))
+        self.model_token_limits = dict(MODEL_TOKEN_LIMITS, **config.get('model_token_limits', {}))
+        self.reply_token_reserve = config.get('reply_token_reserve', 1000)
+        self.reply_token_estimate = config.get('reply_token_estimate', 300)
+        self.max_concurrent_transcriptions = config.get('max_concurrent_transcriptions', 2)
+        self.summary = config.get('summary', {})
+        self.max_resident_users = config.get('max_resident_users', 1000)
+        self.coalesce_window = config.get('coalesce_window', 0.0)
+        self.config_reload_interval = config.get('config_reload_interval', 5.0)
+        self.image_count = min(max(config.get('image_count', 1), 1), MAX_IMAGES)
+        self.image_size = config.get('image_size', "1024x1024")
+        if self.image_size not in IMAGE_SIZES:
+            print("image_size must be one of {}!".format(", ".join(IMAGE_SIZES)))
+            sys.exit()
+        redis_url = config.get('redis_url', "redis://localhost:6379/0")
+        redis_prefix = config.get('redis_prefix', "chatgpt_bot")
+        if redis is None and "redis" in (config.get('storage'), config.get('conversation_state')):
+            print("The redis backend needs the redis package (pip3 install redis)!")
+            sys.exit()
+        self.storage = createStorage(config.get('storage', "json"), config.get('storage_compact_after', 1000), redis_url, redis_prefix)
+        self.state = createState(config.get('conversation_state', "memory"), redis_url, redis_prefix)
+        # also without a flush interval the writes go through WriteBehind, so they never run on the event loop
+        self.storage = WriteBehind(self.storage, config.get('storage_flush_interval', 2.0), config.get('storage_flush_batch', 100))
+        self.users = {} # telegram ID -> User
+        self._loadUsers(config)
+
+    def _loadUsers(self, config) -> None:
+        # the data of a user is only read on first access, known users are kept as they are
+        users = {}
+        for entry in config['users']:
+            if entry:
+                values = entry.split("#")
+                user = self.users.get(values[0])
+                if user is None or user.name != values[1]:
+                    path = './chats/topics_{}.json'.format(values[1])
+                    user = User(values[1], values[0], path, self.max_history_entries * 2, values[2], self.storage)
+                user.language = values[2]
+                users[user.id] = user
+        self.users = users
+
+    def reload(self) -> bool:
+        # takes over users, models and the current model if config.json was changed
+        # while the bot is running, returns True if it was read again
+        mtime = self._mtime()
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            config = self._readFile()
+            self._loadUsers(config)
+            self.models = set(config['models'])
+            self.current_model = config['current_model']
+        except (IOError, json.JSONDecodeError, KeyError) as ex:
+            print("Could not reload config file: {}".format(ex))
+            return False
+        return True
+
+    def _mtime(self):
+        try:
+            return os.stat("config.json").st_mtime_ns
+        except OSError:
+            return None
+
+    def historyTokenBudget(self, model: str) -> int:
+        # tokens left for the prompt after reserving room for the answer
+        return self.model_token_limits.get(model, 4096) - self.reply_token_reserve
+
+    def _readFile(self):
+        with open("config.json", encoding='utf-8-sig') as configFile:
+            return json.load(configFile)
 
     def _loadFile(self):
         # load the configuration ..
         try:
-            configFile = open("config.json", encoding='utf-8-sig')
-            config = json.load(configFile)
-            configFile.close()
-            return config
+            return self._readFile()
         except IOError:
             print("Could not read config file!")
             sys.exit()
@@ -102,23 +992,22 @@ class Config:
             print("config.json: decode error!")
             sys.exit()
 
-    def saveCurrentModel(self) -> None:
-        data = self._loadFile()
-        if data['current_model'] != self.current_model:
-            data['current_model'] = self.current_model
-            configFile = open("config.json", "w")
-            configFile.write(json.dumps(data, indent=4))
-            configFile.close()
-
 # -------------------------------------------------------------------------------------
 
 class Translations:
     def __init__(self) -> None:
         self.translations_data = self._loadFile()
-        self.translations = [{}]
+        # everything is looked up once here, the handlers only hit the dicts
+        self.languages = {}
+        for lang in self.translations_data['lang']:
+            self.languages[lang['key']] = lang['val']
+        self.translations = {} # (token, lang) -> text
+        self.patterns = {} # token -> regex matching the text in all languages
         for obj in self.translations_data['tokens']:
             for key in obj:
-                self.translations.append({key: obj[key]})
+                for lang, index in self.languages.items():
+                    self.translations[(key, lang)] = obj[key][index]
+                self.patterns[key] = re.compile("^({})$".format("|".join(re.escape(value) for value in obj[key])))
 
     def _loadFile(self):
         # load the configuration ..
@@ -131,30 +1020,241 @@ class Translations:
             print("Could not read translations file!")
             sys.exit()
         except json.JSONDecodeError:
-            print("config.json: decode error!")
+            print("translations.json: decode error!")
             sys.exit()
     
     def trans(self, token: str, lang : str) -> str:
-        lang_index = 0 # 'en' as fallback
-        for avail_lang in self.translations_data['lang']:
-            if lang == avail_lang['key']:
-                lang_index = lang['val']
-        return self.translations[token][lang_index]
+        text = self.translations.get((token, lang))
+        if text is None:
+            return self.translations[(token, "en")] # 'en' as fallback
+        return text
     
-    def allTransAsRegex(self, token: str) -> str:
-        for obj in self.translations:
-            for key in obj:
-                if key == token:
-                    regEx_val = "^("
-                    for value in obj[key]:
-                        regEx_val += value + "|"
-                    regEx_val = regEx_val[:-1] + ")$"
-                    return regEx_val
+    def allTransAsRegex(self, token: str):
+        return self.patterns[token]
     
     def langCount(self) -> int:
-        for obj in self.translations:
-            for key in obj:
-                return len(obj[key])
+        return len(self.languages)
+
+# -------------------------------------------------------------------------------------
+
+class ResponseCache:
+    # answers to stateless requests, evicted least recently used first once max_bytes
+    # is reached and dropped after ttl seconds. Optionally saved to a file on shutdown.
+    def __init__(self, ttl: float, max_bytes: int, path: str) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as cachefile:
+                for key, expires, value in json.load(cachefile):
+                    self._add(key, expires, value)
+
+    @staticmethod
+    def key(model: str, messages: list, **parameters) -> str:
+        # whitespace differences do not change the answer
+        normalized = [[message['role'], " ".join(message['content'].split())] for message in messages]
+        return hashlib.sha256(json.dumps([model, normalized, parameters], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            metrics.count("response_cache_total", result="miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.count("response_cache_total", result="hit")
+        return entry[1]
+
+    def put(self, key: str, value, ttl: float = None) -> None:
+        if key in self.entries:
+            self._remove(key)
+        self._add(key, time.time() + (ttl or self.ttl), value)
+
+    def _add(self, key: str, expires: float, value) -> None:
+        self.entries[key] = (expires, value)
+        self.size += self._sizeOf(key, value)
+        while self.size > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        expires, value = self.entries.pop(key)
+        self.size -= self._sizeOf(key, value)
+
+    def _sizeOf(self, key: str, value) -> int:
+        return len(key) + len(json.dumps(value))
+
+    def save(self) -> None:
+        if self.path:
+            now = time.time()
+            _writeJSON(self.path, json.dumps([[key, expires, value] for key, (expires, value) in self.entries.items() if expires > now]))
+
+# -------------------------------------------------------------------------------------
+
+class TokenBucket:
+    # allows per_minute units per minute, bursts up to the same amount. 0 means no limit.
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.level = per_minute
+        self.stamp = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.capacity / 60)
+        self.stamp = now
+
+    def waitTime(self, amount: float) -> float:
+        # seconds until amount is available
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity) # larger requests would wait forever
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        # a negative amount gives back what was taken too much, the level may go below
+        # zero if more was used than estimated
+        if self.capacity:
+            self._refill()
+            self.level = min(self.capacity, self.level - min(amount, self.capacity))
+
+class RequestScheduler:
+    # Queue in front of OpenAI. Requests are limited by requests and tokens per minute,
+    # per user and for the bot as a whole. Waiting requests are served round robin
+    # across the users, so one user with many messages cannot starve the others.
+    def __init__(self, limits: dict) -> None:
+        self.user_limits = limits.get('per_user', {})
+        self.global_buckets = self._buckets(limits.get('global', {}))
+        self.user_buckets = {} # user id -> (requests, tokens)
+        self.queues = OrderedDict() # user id -> deque of (tokens, future), in round robin order
+        self.wakeup = asyncio.Event()
+        self.task = None
+        metrics.gauge("queued_requests", lambda: sum(len(queue) for queue in self.queues.values()))
+
+    def _buckets(self, limits: dict):
+        return TokenBucket(limits.get('requests_per_minute', 0)), TokenBucket(limits.get('tokens_per_minute', 0))
+
+    def _bucketsOf(self, user_id: str):
+        if user_id not in self.user_buckets:
+            self.user_buckets[user_id] = self._buckets(self.user_limits)
+        return self.user_buckets[user_id]
+
+    def _waitTime(self, user_id: str, tokens: int) -> float:
+        waits = [0.0]
+        for requests, token_bucket in (self.global_buckets, self._bucketsOf(user_id)):
+            waits.append(requests.waitTime(1))
+            waits.append(token_bucket.waitTime(tokens))
+        return max(waits)
+
+    def _take(self, user_id: str, tokens: int) -> None:
+        for requests, token_bucket in (self.global_buckets, self._bucketsOf(user_id)):
+            requests.take(1)
+            token_bucket.take(tokens)
+
+    def position(self, user_id: str) -> int:
+        # number of requests served before the last request of user_id
+        queue = self.queues.get(user_id, ())
+        ahead = len(queue) - 1
+        return ahead + sum(min(len(other), ahead + 1) for other_id, other in self.queues.items() if other_id != user_id) + 1
+
+    async def acquire(self, user_id: str, tokens: int, notify=None) -> None:
+        # returns as soon as the request may be sent, notify(position) is awaited
+        # if it has to wait longer than QUEUE_NOTICE_DELAY
+        if not self.queues and self._waitTime(user_id, tokens) == 0:
+            self._take(user_id, tokens)
+            metrics.observe("queue_wait_seconds", 0.0)
+            return
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append((tokens, future))
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+        if notify is not None:
+            done, pending = await asyncio.wait({future}, timeout=QUEUE_NOTICE_DELAY)
+            if pending:
+                await notify(self.position(user_id))
+        await future
+        metrics.observe("queue_wait_seconds", time.perf_counter() - start)
+
+    def used(self, user_id: str, estimated: int, tokens: int) -> None:
+        # correct the estimate once the real token usage is known
+        for requests, token_bucket in (self.global_buckets, self._bucketsOf(user_id)):
+            token_bucket.take(tokens - estimated)
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            waits = []
+            for user_id in list(self.queues):
+                queue = self.queues[user_id]
+                while queue and queue[0][1].done(): # cancelled by the caller
+                    queue.popleft()
+                if not queue:
+                    del self.queues[user_id]
+                    continue
+                tokens, future = queue[0]
+                wait = self._waitTime(user_id, tokens)
+                if wait == 0:
+                    self._take(user_id, tokens)
+                    queue.popleft()
+                    future.set_result(None)
+                    # the user goes to the end of the round
+                    del self.queues[user_id]
+                    if queue:
+                        self.queues[user_id] = queue
+                    break
+                waits.append(wait)
+            else:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(waits) if waits else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await asyncio.sleep(0)
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+# -------------------------------------------------------------------------------------
+
+class ModelCatalog:
+    # the models usable by the bot (available at OpenAI and listed in the config),
+    # fetched at most once per ttl seconds. Concurrent callers share one request.
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.models = None
+        self.fetched = 0.0
+        self.refresh = None
+
+    async def get(self, fetch) -> set:
+        if self.models is not None and time.monotonic() - self.fetched < self.config.model_list_ttl:
+            return self.models
+        if self.refresh is None:
+            self.refresh = asyncio.ensure_future(self._fetch(fetch))
+        refresh = self.refresh
+        try:
+            # shielded, a cancelled caller must not cancel the fetch of the others
+            return await asyncio.shield(refresh)
+        finally:
+            if self.refresh is refresh and refresh.done():
+                self.refresh = None
+
+    async def _fetch(self, fetch) -> set:
+        models = await fetch()
+        self.models = set(model.id for model in models['data']).intersection(self.config.models)
+        self.fetched = time.monotonic()
+        return self.models
 
 # -------------------------------------------------------------------------------------
 
@@ -162,51 +1262,119 @@ class OpenaAI_API:
     def __init__(self, config: Config) -> None:
         self.config = config
         openai.api_key = config.openai_key
-        self.query = [{"role": "user", "content": ""}]
+        # caps the number of requests in flight, the async client never blocks the event loop
+        self.requests = asyncio.Semaphore(config.max_concurrent_requests)
+        self.model_requests = {} # model -> semaphore, for the models in model_concurrency
+        # uploads of voice messages are large, only a few of them run at the same time
+        self.transcriptions = asyncio.Semaphore(config.max_concurrent_transcriptions)
+        self.catalog = ModelCatalog(config)
 
-    def setModel(self, new_model: str) -> None:
-        models = openai.Model.list()
-        if new_model in models['data']:
-            self.config.current_model = new_model
-            self.config.saveCurrentModel()
+    @contextlib.asynccontextmanager
+    async def _slot(self, model: str):
+        # one of the slots of all requests together and, if the model has a limit of its
+        # own in model_concurrency, one of the model, so a slow model cannot take them all
+        limit = self.config.model_concurrency.get(model)
+        if not limit:
+            async with self.requests:
+                yield
+            return
+        if model not in self.model_requests:
+            self.model_requests[model] = asyncio.Semaphore(limit)
+        async with self.model_requests[model], self.requests:
+            yield
 
-    def setQueryText(self, text: str) -> None:
-        self.query[0]['content'] = text
+    async def _request(self, endpoint: str, create, **kwargs):
+        # transient errors are retried with backoff, the slot is given back while waiting
+        async def call():
+            async with self._slot(kwargs.get('model', "")):
+                with metrics.timer("openai_request_seconds", endpoint=endpoint, model=kwargs.get('model', "")):
+                    return await create(**kwargs)
+        return await self.config.openai_retry.run(call, OPENAI_RETRY_ERRORS)
 
-    def getResponse(self) -> str:
-        try:
-            completion = openai.ChatCompletion.create(model=self.config.current_model, messages=self.query)
-            return completion.choices[0].message.content
-        except openai.error.RateLimitError as ex:
-            return ex._message
-        finally:
-            self.query[0]['content'] = ""
+    async def getResponse(self, messages: list, model: str = None) -> str:
+        # everything a request needs is passed in, so parallel requests never share state
+        if model is None:
+            model = self.config.current_model
+        completion = await self._request("chat", openai.ChatCompletion.acreate, model=model, messages=messages)
+        return completion.choices[0].message.content
+
+    async def getResponseStream(self, messages: list, model: str = None):
+        # yields the answer piece by piece as the tokens arrive, only opening the
+        # stream is retried
+        if model is None:
+            model = self.config.current_model
+        async def openStream():
+            # like in _request the slot is taken for each try, it is held while the stream is read
+            slot = contextlib.AsyncExitStack()
+            await slot.enter_async_context(self._slot(model))
+            try:
+                start = time.perf_counter()
+                return slot, start, await openai.ChatCompletion.acreate(model=model, messages=messages, stream=True)
+            except BaseException:
+                await slot.aclose()
+                raise
+        slot, start, stream = await self.config.openai_retry.run(openStream, OPENAI_RETRY_ERRORS)
+        async with slot:
+            first = True
+            async for chunk in stream:
+                content = chunk.choices[0].delta.get('content')
+                if content:
+                    if first:
+                        metrics.observe("openai_first_token_seconds", time.perf_counter() - start, model=model)
+                        first = False
+                    yield content
+            metrics.observe("openai_request_seconds", time.perf_counter() - start, endpoint="chat", model=model)
     
-    def getAvailableModels(self) -> set:
-        models = openai.Model.list()
-        models_list = []
-        for model in models['data']:
-            models_list.append(model.id)
-        models_set = set(models_list)
-        available_models = models_set.intersection(config.models)
-        return available_models
+    async def getAvailableModels(self) -> set:
+        return await self.catalog.get(self._listModels)
+
+    async def _listModels(self):
+        return await self._request("models", openai.Model.alist)
     
-    def getImage(self) -> str:
+    async def getImages(self, prompt: str, size: str = "1024x1024", n: int = 1) -> list:
+        # the images come back as base64 in the response, so Telegram gets the bytes
+        # directly instead of fetching them from the short-lived OpenAI URLs
+        generation_response = await self._request("image", openai.Image.acreate, prompt=prompt, n=n, size=size, response_format="b64_json")
+        return await asyncio.to_thread(lambda: [base64.b64decode(image["b64_json"]) for image in generation_response["data"]])
+
+    async def getTranscription(self, audio_file) -> str:
+        # audio_file is a file object with a name telling the format, e.g. "voice.ogg"
+        async def transcribe(**kwargs):
+            audio_file.seek(0) # a retry uploads the file again
+            return await openai.Audio.atranscribe(**kwargs)
+        async with self.transcriptions:
+            transcription = await self._request("audio", transcribe, model="whisper-1", file=audio_file)
+        return transcription["text"]
+
+# -------------------------------------------------------------------------------------
+
+class UserUpdateProcessor(BaseUpdateProcessor):
+    # updates of different users are handled at the same time, those of one user one
+    # after the other in the order they arrived, as the conversations need it
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        self.users = {} # user id -> [lock, number of updates waiting for it]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        entry = self.users.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            generation_response = openai.Image.create(prompt=self.query[0]['content'], n=1, size="1024x1024", response_format="url")
-            return generation_response["data"][0]["url"] # extract image URL from response
-        except openai.error.RateLimitError as ex:
-            return ex._message
+            async with entry[0]:
+                await coroutine
         finally:
-            self.query[0]['content'] = ""
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.users[user.id]
 
-    def getTranscription(self, audio_file) -> str:
-        try:
-            transcription = openai.Audio.transcribe(audio_file)
-            pass
-        except openai.error.RateLimitError as ex:
-            return ex._message
-        return ""
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 # -------------------------------------------------------------------------------------
 
@@ -215,13 +1383,35 @@ class ChatGPTBot:
         self.config = config
         self.openai_api = openaiAPI
         self.lang = languages
-        self.updater = Application.builder().token(self.config.telegram_token).build()
+        self.retry = config.telegram_retry
+        self.sent_replies = OrderedDict()
+        self.transcripts = OrderedDict() # file_unique_id -> task returning the transcript
+        self.summaries = {} # (user id, topic) -> running summarization
+        self.chat_queues = {} # user id -> chat messages waiting for the worker of the user
+        self.resident = OrderedDict() # user id -> user with loaded data, least recently seen first
+        self.loading = {} # user id -> task loading the user data
+        self.config_watcher = None
+        metrics.gauge("resident_users", lambda: len(self.resident))
+        self.scheduler = RequestScheduler(config.rate_limits)
+        self.cache = None
+        if self.config.response_cache.get('enabled', False):
+            self.cache = ResponseCache(self.config.response_cache.get('ttl', 3600), self.config.response_cache.get('max_bytes', 10000000),
+                                       self.config.response_cache.get('path', ""))
+        self.updater = Application.builder().token(self.config.telegram_token).persistence(StatePersistence(self.config.state)) \
+            .concurrent_updates(UserUpdateProcessor(self.config.max_concurrent_updates)) \
+            .post_init(self._postInit).post_shutdown(self._postShutdown).build()
+
+        self.updater.add_error_handler(self.onError)
+
+        # updates of unknown users are stopped before any other handler sees them
+        self.updater.add_handler(TypeHandler(Update, self.authorize), group=-1)
 
         # add event handlers..
         self.updater.add_handler(CommandHandler('h', self.help))
         self.updater.add_handler(CommandHandler('help', self.help))
         self.updater.add_handler(CommandHandler('hilfe', self.help))
         self.updater.add_handler(CommandHandler('start', self.start))
+        self.updater.add_handler(CommandHandler('stats', self.stats))
 
         # conversations
         # topic conversation
@@ -230,12 +1420,12 @@ class ChatGPTBot:
             entry_points = [CommandHandler("topic", self.topic)],
             states = {
                 self.SELECTION: [
-                    MessageHandler(filters.Regex("^neues Thema$"), self.newtopic),
-                    MessageHandler(filters.Regex("^vorhandenes Thema$"), self.existingtopic),
-                    MessageHandler(filters.Regex("^ohne Thema$"), self.cleartopic),
-                    MessageHandler(filters.Regex("^zeige aktuelles Thema$"), self.currenttopic),
-                    MessageHandler(filters.Regex("^lösche Thema$"), self.deletetopic),
-                    MessageHandler(filters.Regex("^abbrechen$"), self.cancel)
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("newTopic")), self.newtopic),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("existingTopic")), self.existingtopic),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("withoutTopic")), self.cleartopic),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("showCurrentTopic")), self.currenttopic),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("deleteTopic")), self.deletetopic),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("cancel")), self.cancel)
                 ],
                 self.TOPICSELECTION: [
                     MessageHandler(filters.Regex(".*"), self.setselectedtopic)
@@ -246,84 +1436,97 @@ class ChatGPTBot:
                 self.NEWTOPIC: [
                     MessageHandler(filters.Regex(".*"), self.newtopicname)
                 ]
-            }, fallbacks=[CommandHandler("cancel", self.cancel)])
+            }, fallbacks=[CommandHandler("cancel", self.cancel)], name="topic", persistent=True)
         self.updater.add_handler(topic_handler)
 
+        # the OpenAI conversations run as non-blocking tasks, so a slow completion
+        # of one user does not hold back the updates of all others. Messages arriving
+        # while a step is still running are answered by the WAITING handlers instead
+        # of being dropped.
+        waiting = [MessageHandler(filters.ALL, self.busy)]
         # model conversation
         self.MODELSELECT, self.MODELSELECTED = range(2)
         model_handler = ConversationHandler(
             entry_points = [CommandHandler("model", self.model)],
             states = {
                 self.MODELSELECT: [
-                    MessageHandler(filters.Regex("^Modell wählen$"), self.setmodel),
-                    MessageHandler(filters.Regex("^zeige aktuelles Modell$"), self.showmodel)
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("chooseModel")), self.setmodel),
+                    MessageHandler(filters.Regex(self.lang.allTransAsRegex("showCurrentModel")), self.showmodel)
                 ],
                 self.MODELSELECTED: [
                     MessageHandler(filters.Regex(".*"), self.setnewmodel)
-                ]
-            }, fallbacks=[CommandHandler("cancel", self.cancel)])
+                ],
+                ConversationHandler.WAITING: waiting
+            }, fallbacks=[CommandHandler("cancel", self.cancel)], block=False, name="model", persistent=True)
         self.updater.add_handler(model_handler)
 
-        # chat conversation
-        self.CHAT = range(1)
+        # chat conversation, the handlers only queue the messages for the worker task
+        # of the user, so they keep the order in which they arrived
+        self.CHAT = 0
         chat_handler = ConversationHandler(
             entry_points = [CommandHandler('chat', self.chat_query)],
             states = {
                 self.CHAT: [
-                    MessageHandler(filters.Regex(".*"), self.chat_query)
+                    MessageHandler(filters.Regex(".*"), self.chat_query),
+                    MessageHandler(filters.VOICE, self.chat_voice)
                 ]
-            }, fallbacks=[CommandHandler("cancel", self.cancel)])
+            }, fallbacks=[CommandHandler("cancel", self.cancel)], name="chat", persistent=True)
         self.updater.add_handler(chat_handler)
 
         # image creation conversation
-        self.CREATEIMAGE = range(1)
+        self.CREATEIMAGE = 0
         image_handler = ConversationHandler(
             entry_points = [CommandHandler('image', self.image)],
             states = {
                 self.CREATEIMAGE: [
                     MessageHandler(filters.Regex(".*"), self.create_image)
-                ]
-            }, fallbacks=[CommandHandler("cancel", self.cancel)])
+                ],
+                ConversationHandler.WAITING: waiting
+            }, fallbacks=[CommandHandler("cancel", self.cancel)], block=False, name="image", persistent=True)
         self.updater.add_handler(image_handler)
+
+        # compare conversation, one question is sent to all models at the same time
+        self.COMPARE = 0
+        compare_handler = ConversationHandler(
+            entry_points = [CommandHandler('compare', self.compare)],
+            states = {
+                self.COMPARE: [
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.compare_query)
+                ],
+                ConversationHandler.WAITING: waiting
+            }, fallbacks=[CommandHandler("cancel", self.cancel)], block=False, name="compare", persistent=True)
+        self.updater.add_handler(compare_handler)
         
     async def topic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
         if user:
             reply_keyboard = []
-            reply_keyboard.append(["neues Thema"])
-            reply_keyboard.append(["vorhandenes Thema"])
-            reply_keyboard.append(["ohne Thema"])
-            reply_keyboard.append(["zeige aktuelles Thema"])
-            reply_keyboard.append(["lösche Thema"])
-            reply_keyboard.append(["abbrechen"])
-            try:
-                await update.message.reply_text("Wie kann ich helfen?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
-            except error.NetworkError:
-                self.updater = Application.builder().token(self.config.telegram_token).build()
-                return self.topic(update, context)
+            reply_keyboard.append([self._trans(update, "newTopic")])
+            reply_keyboard.append([self._trans(update, "existingTopic")])
+            reply_keyboard.append([self._trans(update, "withoutTopic")])
+            reply_keyboard.append([self._trans(update, "showCurrentTopic")])
+            reply_keyboard.append([self._trans(update, "deleteTopic")])
+            reply_keyboard.append([self._trans(update, "cancel")])
+            await self._reply(update, self._trans(update, "helpYou"), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
         return self.SELECTION
         
     async def newtopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        try:
-            await update.message.reply_text("Thema?\nMöglichst als ein Wort!", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.newtopic(update, context)
+        await self._reply(update, "{}\n{}".format(self._trans(update, "topicName"), self._trans(update, "asOneWord")), reply_markup= ReplyKeyboardRemove())
         return self.NEWTOPIC
     
     async def newtopicname(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        user.data['current_topic'] = update.message.text
-        try:
-            if update.message.text in user.topics():
-                await update.message.reply_text("Thema existiert schon und ist jetzt aktiv!", reply_markup= ReplyKeyboardRemove())
-            else:
-                user.data['topics'].append({"name": update.message.text.strip(), "history": []})
-                user.save()
-                await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.newtopicname(update, context)
+        topic = update.message.text.strip()
+        async with self._userSection(user):
+            exists = topic in user.topics()
+            if not exists:
+                user.addTopic(topic)
+            user.setCurrentTopic(topic)
+            user.save()
+        if exists:
+            await self._reply(update, self._trans(update, "topicExists"), reply_markup= ReplyKeyboardRemove())
+        else:
+            await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
 
     async def existingtopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -332,45 +1535,31 @@ class ChatGPTBot:
         topics = user.topics()
         for topic in topics:
             reply_keyboard.append([topic])
-        try:
-            await update.message.reply_text("Deine Themen:", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.existingtopic(update, context)
+        await self._reply(update, self._trans(update, "yourTopics"), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
         return self.TOPICSELECTION
 
     async def setselectedtopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        user.data['current_topic'] = update.message.text
-        user.save()
-        try:
-            await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.setselectedtopic(update, context)
+        async with self._userSection(user):
+            user.setCurrentTopic(update.message.text)
+            user.save()
+        await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
 
     async def cleartopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        user.data['current_topic'] = ""
-        user.save()
-        try:
-            await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.cleartopic(update, context)
+        async with self._userSection(user):
+            user.setCurrentTopic("")
+            user.save()
+        await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
     
     async def currenttopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        try:
-            if user.hasActiveTopic():
-                await update.message.reply_text("aktuelles Thema:\n{}".format(user.data['current_topic']), reply_markup= ReplyKeyboardRemove())    
-            else:
-                await update.message.reply_text("aktuelles Thema:\n keines", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.currenttopic(update, context)
+        if user.hasActiveTopic():
+            await self._reply(update, "{}\n{}".format(self._trans(update, "actualTopic"), user.data['current_topic']), reply_markup= ReplyKeyboardRemove())    
+        else:
+            await self._reply(update, "{}\n{}".format(self._trans(update, "actualTopic"), self._trans(update, "none")), reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
 
     async def deletetopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -379,172 +1568,631 @@ class ChatGPTBot:
         topics = user.topics()
         for topic in topics:
             reply_keyboard.append([topic])
-        try:
-            await update.message.reply_text("Deine Themen:", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.deletetopic(update, context)
+        await self._reply(update, self._trans(update, "yourTopics"), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
         return self.TOPICSELECTION_DELETE
     
     async def deleteselectedtopic(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        if user.data['current_topic'] == update.message.text:
-            user.data['current_topic'] = ""
-        counter = 0
-        for topic in user.data['topics']:
-            if update.message.text == topic['name']:
-                del user.data['topics'][counter]
-            else:
-                counter += 1
-        user.save()
-        try:
-            await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.deleteselectedtopic(update, context)
+        async with self._userSection(user):
+            user.deleteTopic(update.message.text)
+            user.save()
+        await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
     
     async def model(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         if self._isUser(update):
             reply_keyboard = []
-            reply_keyboard.append(["zeige aktuelles Modell"])
-            reply_keyboard.append(["Modell wählen"])
-            try:
-                await update.message.reply_text("Wähle?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
-            except error.NetworkError:
-                self.updater = Application.builder().token(self.config.telegram_token).build()
-                return self.model(update, context)
+            reply_keyboard.append([self._trans(update, "showCurrentModel")])
+            reply_keyboard.append([self._trans(update, "chooseModel")])
+            await self._reply(update, self._trans(update, "choose"), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
         return self.MODELSELECT
     
     async def showmodel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        try:
-            await update.message.reply_text("Das aktuell verwendete Modell: {}".format(self.config.current_model), reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.showmodel(update, context)
+        user = self.userById(update)
+        model = user.modelOf(user.data['current_topic'], self.config.current_model)
+        await self._reply(update, "{} {}".format(self._trans(update, "currentModel"), model), reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
     
     async def setmodel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # create selection of models to choose from ..
-        available_models = self.openai_api.getAvailableModels()
+        try:
+            available_models = await self.openai_api.getAvailableModels()
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"), reply_markup= ReplyKeyboardRemove())
+            return ConversationHandler.END
         reply_keyboard = []
         for model in available_models:
             reply_keyboard.append([model])
-        try:
-            await update.message.reply_text("Verfügbare Modelle:", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.setmodel(update, context)
+        await self._reply(update, self._trans(update, "availableModels"), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
         return self.MODELSELECTED
 
     async def setnewmodel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        # set the new model for this bot
-        self.openai_api.setModel(update.message.text)
+        # set the model for the current topic of the user, or for the user without a topic
+        user = self.userById(update)
         try:
-            await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.setnewmodel(update, context)
+            available = update.message.text in await self.openai_api.getAvailableModels()
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"), reply_markup= ReplyKeyboardRemove())
+            return ConversationHandler.END
+        if not available:
+            await self._reply(update, self._trans(update, "unknownModel"), reply_markup= ReplyKeyboardRemove())
+            return ConversationHandler.END
+        async with self._userSection(user):
+            user.setModel(update.message.text, user.data['current_topic'])
+            user.save()
+        await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
 
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        try:
-            await update.message.reply_text("OK", reply_markup= ReplyKeyboardRemove())
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            return self.cancel(update, context)
+        await self._reply(update, "OK", reply_markup= ReplyKeyboardRemove())
         return ConversationHandler.END
 
+    async def busy(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # the previous step of the conversation has not finished yet
+        await self._reply(update, self._trans(update, "stillWorking"))
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        try:
-            if self._isUser(update):
-                await update.message.reply_text("Wilkommen beim ChatGPT Telegram Bot!")
-            else:
-                await update.message.reply_text("You are not in the valid users list!")
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            self.start(update, context)
+        if self._isUser(update):
+            await self._reply(update, self._trans(update, "welcome"))
+        else:
+            await self._reply(update, self._trans(update, "notInUserList"))
 
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        try:
-            if self._isUser(update):
-                await update.message.reply_text("Wilkommen beim ChatGPT Telegram Bot!")
-            else:
-                await update.message.reply_text("You are not in the valid users list!")
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            self.help(update, context)
+        if self._isUser(update):
+            await self._reply(update, self._trans(update, "welcome"))
+        else:
+            await self._reply(update, self._trans(update, "notInUserList"))
+
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if str(update.effective_user.id) in self.config.admins:
+            await self._reply(update, metrics.summary()[:MESSAGE_LIMIT] or "-")
 
     async def chat_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user = self.userById(update)
+        if user:
+            # filter commands
+            if update.message.text == "/cancel":
+                if user.id in self.chat_queues:
+                    self.chat_queues[user.id].clear() # only the answer being written is finished
+                await self._reply(update, "OK")
+                return ConversationHandler.END
+            elif update.message.text[0] == "/":
+                return self.CHAT
+            self._queueChat(update, user)
+            return self.CHAT
+        else:
+            await self._reply(update, self._trans(update, "notInUserList"))
+        return ConversationHandler.END
+    
+    async def chat_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user = self.userById(update)
+        if user:
+            self._queueChat(update, user)
+            return self.CHAT
+        else:
+            await self._reply(update, self._trans(update, "notInUserList"))
+        return ConversationHandler.END
+
+    def _queueChat(self, update: Update, user: User) -> None:
+        # the messages of a user are answered one after the other by a worker task,
+        # which is started for the first message and ends when the queue is empty
+        queue = self.chat_queues.get(user.id)
+        if queue is None:
+            queue = self.chat_queues[user.id] = deque()
+            self.updater.create_task(self._chatWorker(user, queue), update=update)
+        queue.append(update)
+
+    async def _chatWorker(self, user: User, queue: deque) -> None:
+        # with a coalesce_window the messages sent within it are merged into one
+        # question, as are all messages which arrive while an answer is written
+        window = self.config.coalesce_window
         try:
-            user = self.userById(update)
-            if user:
-                # filter commands
-                if update.message.text == "/cancel":
-                    await update.message.reply_text("OK")
-                    return ConversationHandler.END
-                elif update.message.text[0] == "/":
-                    return self.CHAT
-                # chat with or without history..
+            if window > 0:
+                await asyncio.sleep(window)
+            while queue:
+                if window > 0:
+                    batch = list(queue)
+                    queue.clear()
+                    metrics.count("coalesced_messages_total", len(batch) - 1)
                 else:
-                    user = self.userById(update)
-                    response = ""
-                    if user.hasActiveTopic(): # chat with active topic
-                        currentTopic = user.data['current_topic']
-                        currentHistory = user.historyOfTopic(currentTopic)
-                        currentHistory.append(update.message.text)
-                        new_query_with_history = "\n".join(currentHistory)
-                        self.openai_api.setQueryText(new_query_with_history)
-                        response = self.openai_api.getResponse()
-                        currentHistory.append(response)
-                        user.updateHistory(currentTopic, currentHistory)
+                    batch = [queue.popleft()]
+                try:
+                    texts = []
+                    for update in batch:
+                        text = await self._messageText(update, user)
+                        if text:
+                            texts.append(text)
+                    if texts:
+                        await self._chat(batch[-1], user, "\n\n".join(texts))
+                except Exception as ex:
+                    # e.g. a Telegram error, the messages still queued are answered anyway
+                    print("Could not answer a message: {}".format(ex))
+                    try:
+                        await self._reply(batch[-1], self._trans(batch[-1], "answerFailed"))
+                    except error.TelegramError:
+                        pass
+        finally:
+            self.chat_queues.pop(user.id, None)
+
+    async def _messageText(self, update: Update, user: User):
+        # the text of a message, voice messages are transcribed. None if there is nothing to answer.
+        voice = update.message.voice
+        if voice is None:
+            return update.message.text
+        if voice.file_size and voice.file_size > VOICE_SIZE_LIMIT:
+            await self._reply(update, self._trans(update, "voiceTooLarge"))
+            return None
+        try:
+            text = await self._transcript(update, user, voice)
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"))
+            return None
+        if not text.strip():
+            return None
+        # a long voice message gives a transcript over the message limit
+        await self._replyLong(update, self._trans(update, "voiceTranscript").format(text))
+        return text
+
+    async def _chat(self, update: Update, user: User, text: str) -> None:
+        # chat with or without history. The user section is held to read the history and
+        # again to store the answer, but not during the request, so the other updates of
+        # the user (e.g. the topic commands) do not wait for the answer.
+        try:
+            async with self._userSection(user):
+                currentTopic = user.data['current_topic']
+                model = user.modelOf(currentTopic, self.config.current_model)
+                if currentTopic:
+                    question = historyMessage("user", text, model)
+                    # the summary of older entries goes first, it counts against the budget as well
+                    summary = [user.summaryOfTopic(currentTopic)] if user.summaryOfTopic(currentTopic) else []
+                    budget = self.config.historyTokenBudget(model) - question['tokens'] - sum(message['tokens'] for message in summary)
+                    user.trimHistory(currentTopic, budget)
+                    user.save()
+                    history = summary + list(user.historyOfTopic(currentTopic)) + [question]
+            if currentTopic: # chat with active topic
+                messages = promptMessages(history)
+                prompt_tokens = sum(message['tokens'] for message in history)
+                response = await self._scheduledAnswer(update, user, messages, prompt_tokens, model)
+                async with self._userSection(user):
+                    # the topic may have been deleted meanwhile
+                    if currentTopic in user.topics():
+                        user.updateHistory(currentTopic, [question, historyMessage("assistant", response, model)])
                         user.save()
-                    else: # chat without topic
-                        self.openai_api.setQueryText(update.message.text)
-                        response = self.openai_api.getResponse()
-                    if response != "":
-                        await update.message.reply_text(response)
-                    return self.CHAT
-            else:
-                await update.message.reply_text("You are not in the valid users list!")
-        except error.NetworkError:
-            self.updater = Application.builder().token(self.config.telegram_token).build()
-            self.chat_query(update, context)
+                        self._startSummary(update, user, currentTopic)
+            else: # chat without topic, the same question gets the same answer from the cache
+                messages = [{"role": "user", "content": text}]
+                key = ResponseCache.key(model, messages)
+                response = self.cache.get(key) if self.cache else None
+                if response is not None:
+                    await self._replyLong(update, response)
+                else:
+                    response = await self._scheduledAnswer(update, user, messages, countTokens(text, model), model)
+                    if self.cache and response != "":
+                        self.cache.put(key, response)
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"))
+
+    def _startSummary(self, update: Update, user: User, topic: str) -> None:
+        # once the history of a topic gets long its older entries are summarized in the
+        # background, the answer has been sent already. Started as task of the application
+        # so unexpected errors (e.g. of the storage) reach onError.
+        if not self.config.summary.get('enabled', False) or (user.id, topic) in self.summaries:
+            return
+        history = user.historyOfTopic(topic)
+        keep = max(self.config.summary.get('keep_entries', 2), 1) * 2
+        if len(history) <= keep:
+            return
+        # before max_history_entries would drop entries without a summary
+        if sum(message['tokens'] for message in history) > self.config.summary.get('threshold', 1500) or len(history) >= user.max_entries:
+            self.summaries[(user.id, topic)] = self.updater.create_task(self._summarize(user, topic, keep), update=update)
+
+    async def _summarize(self, user: User, topic: str, keep: int) -> None:
+        model = self.config.summary.get('model', "gpt-3.5-turbo")
+        try:
+            async with self._userSection(user):
+                old = list(user.historyOfTopic(topic))[:-keep]
+                summary = user.summaryOfTopic(topic)
+            conversation = "\n\n".join("{}: {}".format(message['role'], message['content']) for message in old)
+            if summary:
+                conversation = "{}\n\n{}".format(summary['content'], conversation)
+            messages = [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": conversation}]
+            prompt_tokens = countTokens(SUMMARY_PROMPT, model) + countTokens(conversation, model)
+            estimated = prompt_tokens + self.config.reply_token_estimate
+            await self.scheduler.acquire(user.id, estimated)
+            text = await self.openai_api.getResponse(messages, model)
+            completion_tokens = countTokens(text, model)
+            self.scheduler.used(user.id, estimated, prompt_tokens + completion_tokens)
+            metrics.count("tokens_total", prompt_tokens, model=model, kind="summary_prompt")
+            metrics.count("tokens_total", completion_tokens, model=model, kind="summary_completion")
+            async with self._userSection(user):
+                # skipped if the history changed meanwhile, e.g. the topic was deleted
+                if topic in user.topics() and list(user.historyOfTopic(topic))[:len(old)] == old:
+                    user.summarizeHistory(topic, len(old), historyMessage("system", SUMMARY_PREFIX + text, user.modelOf(topic, self.config.current_model)))
+                    user.save()
+        except openai.error.OpenAIError as ex:
+            print("Could not summarize the topic: {}".format(ex))
+        finally:
+            self.summaries.pop((user.id, topic), None)
+
+    async def _transcript(self, update: Update, user: User, voice) -> str:
+        # the same voice message (e.g. forwarded) has the same file_unique_id, it is
+        # transcribed once and parallel requests for it share the transcription
+        task = self.transcripts.get(voice.file_unique_id)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = asyncio.create_task(self._transcribe(update, user, voice))
+            self.transcripts[voice.file_unique_id] = task
+            while len(self.transcripts) > TRANSCRIPTS_KEPT:
+                self.transcripts.popitem(last=False)
+        else:
+            self.transcripts.move_to_end(voice.file_unique_id)
+        return await asyncio.shield(task)
+
+    async def _transcribe(self, update: Update, user: User, voice) -> str:
+        # the voice message is downloaded into memory and uploaded from there
+        voice_file = await self._send(voice.get_file, idempotent=True)
+        buffer = io.BytesIO()
+        async def download():
+            # a retry starts over with an empty buffer
+            buffer.seek(0)
+            buffer.truncate()
+            await voice_file.download_to_memory(buffer)
+        await self._send(download, idempotent=True)
+        buffer.name = "voice.ogg"
+        await self.scheduler.acquire(user.id, 0, self._queueNotice(update))
+        return await self.openai_api.getTranscription(buffer)
+
+    async def compare(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if self._isUser(update):
+            await self._reply(update, self._trans(update, "compareQuestion"))
+            return self.COMPARE
+        else:
+            await self._reply(update, self._trans(update, "notInUserList"))
+            return ConversationHandler.END
+
+    async def compare_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        # the question goes to all available models at once, each answer is sent as soon
+        # as it arrives. Nothing is added to the topic history.
+        user = self.userById(update)
+        try:
+            models = sorted(await self.openai_api.getAvailableModels())
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"))
+            return ConversationHandler.END
+        messages = [{"role": "user", "content": update.message.text}]
+        for answer in asyncio.as_completed([self._compareAnswer(update, user, model, messages) for model in models]):
+            await self._replyLong(update, await answer)
         return ConversationHandler.END
-    
+
+    async def _compareAnswer(self, update: Update, user: User, model: str, messages: list) -> str:
+        try:
+            response = await self._scheduled(user, countTokens(messages[0]['content'], model), model,
+                                             lambda: self.openai_api.getResponse(messages, model))
+        except openai.error.OpenAIError:
+            response = self._trans(update, "requestFailed")
+        return "{}:\n{}".format(model, response)
+
     async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
         if user:
-            await update.message.reply_text("Beschreibe das Bild..")
+            await self._reply(update, self._trans(update, "describeImage"))
             return self.CREATEIMAGE
         else:
-            await update.message.reply_text("You are not in the valid users list!")
+            await self._reply(update, self._trans(update, "notInUserList"))
             return ConversationHandler.END
 
     async def create_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user = self.userById(update)
-        self.openai_api.setQueryText(update.message.text)
-        generated_image_url = self.openai_api.getImage()
-        await self.updater.bot.send_photo(chat_id=user.id, photo=generated_image_url)
+        size, count = self.config.image_size, self.config.image_count
+        # images sent before are in the cache as Telegram file_ids, which never expire
+        key = ResponseCache.key("image", [{"role": "user", "content": update.message.text}], size=size, n=count)
+        file_ids = self.cache.get(key) if self.cache else None
+        if file_ids is not None:
+            await self._sendPhotos(update, file_ids)
+            return ConversationHandler.END
+        try:
+            await self.scheduler.acquire(user.id, 0, self._queueNotice(update))
+            images = await self.openai_api.getImages(update.message.text, size, count)
+        except openai.error.OpenAIError:
+            await self._reply(update, self._trans(update, "requestFailed"))
+            return ConversationHandler.END
+        file_ids = await self._sendPhotos(update, images)
+        if self.cache:
+            self.cache.put(key, file_ids)
         return ConversationHandler.END
 
+    async def _sendPhotos(self, update: Update, photos: list) -> list:
+        # photos are bytes or file_ids, several are sent as one album. Returns the
+        # file_ids of the sent photos.
+        if len(photos) == 1:
+            messages = [await self._send(lambda: update.message.reply_photo(photos[0]))]
+        else:
+            messages = await self._send(lambda: update.message.reply_media_group([InputMediaPhoto(photo) for photo in photos]))
+        return [message.photo[-1].file_id for message in messages]
+
+    async def _scheduledAnswer(self, update: Update, user: User, messages: list, prompt_tokens: int, model: str) -> str:
+        return await self._scheduled(user, prompt_tokens, model, lambda: self._answer(update, messages, model), self._queueNotice(update))
+
+    async def _scheduled(self, user: User, prompt_tokens: int, model: str, request, notify=None) -> str:
+        # wait for the rate limits, the answer is estimated with reply_token_estimate tokens
+        estimated = prompt_tokens + self.config.reply_token_estimate
+        await self.scheduler.acquire(user.id, estimated, notify)
+        response = await request()
+        completion_tokens = countTokens(response, model)
+        self.scheduler.used(user.id, estimated, prompt_tokens + completion_tokens)
+        metrics.count("tokens_total", prompt_tokens, model=model, kind="prompt")
+        metrics.count("tokens_total", completion_tokens, model=model, kind="completion")
+        return response
+
+    def _queueNotice(self, update: Update):
+        async def notify(position: int) -> None:
+            await self._reply(update, self._trans(update, "queuePosition").format(position))
+        return notify
+
+    async def _answer(self, update: Update, messages: list, model: str = None) -> str:
+        # query OpenAI and send the answer to the user, returns the complete answer
+        if self.config.stream_responses:
+            return await self._replyStreamed(update, self.openai_api.getResponseStream(messages, model))
+        response = await self.openai_api.getResponse(messages, model)
+        if response != "":
+            await self._replyLong(update, response)
+        return response
+
+    async def _replyStreamed(self, update: Update, chunks) -> str:
+        # show a placeholder at once and edit the arriving text into it. Edits are throttled
+        # to stay within Telegram's rate limits, text beyond the message size limit rolls
+        # over into a new message.
+        message = await self._send(lambda: update.message.reply_text(STREAM_PLACEHOLDER))
+        response = ""
+        offset = 0 # start of the text shown in the current message
+        shown = STREAM_PLACEHOLDER
+        next_edit = 0.0
+        try:
+            async for chunk in chunks:
+                response += chunk
+                while len(response) - offset > MESSAGE_LIMIT:
+                    cut = response.rfind("\n", offset, offset + MESSAGE_LIMIT) + 1
+                    if cut <= offset:
+                        cut = offset + MESSAGE_LIMIT
+                    if shown != response[offset:cut]:
+                        text = response[offset:cut]
+                        await self._send(lambda: message.edit_text(text), idempotent=True)
+                    offset = cut
+                    shown = response[offset:offset + MESSAGE_LIMIT] or STREAM_PLACEHOLDER
+                    message = await self._send(lambda: update.message.reply_text(shown))
+                    next_edit = time.monotonic() + self.config.stream_edit_interval
+                if time.monotonic() >= next_edit and shown != response[offset:]:
+                    # intermediate edits are not retried, the next one shows the text anyway
+                    try:
+                        await message.edit_text(response[offset:])
+                        shown = response[offset:]
+                        next_edit = time.monotonic() + self.config.stream_edit_interval
+                    except error.RetryAfter as ex:
+                        next_edit = time.monotonic() + ex.retry_after
+                    except error.NetworkError:
+                        next_edit = time.monotonic() + self.config.stream_edit_interval
+        finally:
+            await chunks.aclose() # gives the request slot back at once, also if sending failed
+            # the final edit must not get lost to the throttling, also not if the stream broke
+            if response[offset:] == "":
+                await self._send(message.delete, idempotent=True)
+            elif shown != response[offset:]:
+                await self._send(lambda: message.edit_text(response[offset:]), idempotent=True)
+        return response
+
+    async def _send(self, call, idempotent: bool = False):
+        # every call to Telegram goes through here and is retried on transient errors. A
+        # message whose request timed out may have been delivered anyway, so sending is
+        # not repeated then, only calls which can be repeated safely (edits, downloads).
+        no_retry = (error.BadRequest,) if idempotent else (error.BadRequest, error.TimedOut)
+        return await self.retry.run(call, (error.NetworkError, error.RetryAfter), no_retry)
+
+    async def _reply(self, update: Update, text: str, **kwargs):
+        # a reply that was already sent for this update, e.g. before the update got
+        # delivered again, is not sent twice
+        key = (update.update_id, update.effective_chat.id, hashlib.sha1(text.encode()).hexdigest())
+        if key in self.sent_replies:
+            return None
+        message = await self._send(lambda: update.message.reply_text(text, **kwargs))
+        self.sent_replies[key] = True
+        if len(self.sent_replies) > SENT_REPLIES_KEPT:
+            self.sent_replies.popitem(last=False)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def _userSection(self, user: User):
+        # the changes of a user run one after the other, with a shared state also across
+        # bot processes. Data changed by another process is loaded again and the own
+        # changes are saved before the next one may go on.
+        async with self.config.state.lock("user:{}".format(user.id)):
+            storage = self.config.storage
+            if storage.shared and not await asyncio.to_thread(storage.isCurrent, user):
+                user.unload()
+            await self._loadUser(user)
+            try:
+                yield
+            finally:
+                if storage.shared or storage.flush_interval <= 0:
+                    await storage.flush()
+
+    async def _replyLong(self, update: Update, text: str) -> None:
+        # a text of any length, in as many messages as needed
+        for part in splitMessage(text):
+            await self._reply(update, part)
+
+    async def _loadUser(self, user: User) -> None:
+        # loading may take several round-trips to the storage (e.g. redis), so it runs in a
+        # worker thread, and only once if several tasks need the user at the same time
+        if user.loaded:
+            return
+        task = self.loading.get(user.id)
+        if task is None:
+            task = self.loading[user.id] = asyncio.ensure_future(asyncio.to_thread(self.config.storage.load, user))
+            task.add_done_callback(lambda _: self.loading.pop(user.id, None))
+        await asyncio.shield(task)
+
+    async def onError(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        print("Error while handling an update: {}".format(context.error))
+
+    async def _postInit(self, application: Application) -> None:
+        self.metrics_server = None
+        if self.config.metrics.get('enabled', False):
+            server = web.Application()
+            server.router.add_get("/metrics", self._metricsPage)
+            self.metrics_server = web.AppRunner(server)
+            await self.metrics_server.setup()
+            await web.TCPSite(self.metrics_server, self.config.metrics.get('listen', "127.0.0.1"), self.config.metrics.get('port', 9090)).start()
+        self.config.storage.start()
+        if self.config.config_reload_interval > 0:
+            self.config_watcher = asyncio.create_task(self._watchConfig())
+
+    async def _postShutdown(self, application: Application) -> None:
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+        if self.config_watcher:
+            self.config_watcher.cancel()
+        for task in list(self.summaries.values()):
+            task.cancel()
+        await self.scheduler.stop()
+        await self.config.storage.stop()
+        if self.cache:
+            self.cache.save()
+
     def run(self) -> None:
         print("listening..")
-        self.updater.run_polling()
+        if self.config.webhook.get('enabled', False):
+            asyncio.run(self._runWebhook())
+        else:
+            self.updater.run_polling()
+
+    async def _runWebhook(self) -> None:
+        # Telegram posts the updates to an embedded HTTP server. The updates are put into
+        # the update queue right away, so the server answers at once and several bot
+        # workers can run behind a load balancer. Each user belongs to one of the workers,
+        # the others pass the updates of the user on to it.
+        webhook = self.config.webhook
+        server = web.Application()
+        server.router.add_post(webhook.get('path', "/telegram"), self._webhookUpdate)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        self.forward_session = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+        ssl_context = None
+        if webhook.get('cert'):
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(webhook['cert'], webhook.get('key'))
+        site = web.TCPSite(runner, webhook.get('listen', "0.0.0.0"), webhook.get('port', 8443), ssl_context=ssl_context)
+
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        async with self.updater:
+            await self._postInit(self.updater)
+            await self.updater.start()
+            if webhook.get('url'):
+                certificate = open(webhook['cert'], 'rb') if webhook.get('cert') else None
+                try:
+                    await self.updater.bot.set_webhook(webhook['url'], certificate=certificate, secret_token=webhook['secret_token'])
+                finally:
+                    if certificate:
+                        certificate.close()
+            await site.start()
+            try:
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+                await self.forward_session.close()
+                await self.updater.stop()
+                await self._postShutdown(self.updater)
+
+    async def _metricsPage(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def _webhookUpdate(self, request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.config.webhook['secret_token']:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                return web.Response(status=400)
+            update = Update.de_json(data, self.updater.bot)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return web.Response(status=400)
+        worker = None if request.headers.get(FORWARDED_HEADER) else self._workerOf(update)
+        if worker is not None:
+            return await self._forward(worker, data)
+        await self.updater.update_queue.put(update)
+        return web.Response()
+
+    def _workerOf(self, update: Update):
+        # URL of the worker the user belongs to, None for this one. As all updates of a
+        # user go to the same worker, it handles them in order.
+        workers = self.config.webhook.get('workers', [])
+        if len(workers) < 2 or update.effective_user is None:
+            return None
+        index = update.effective_user.id % len(workers)
+        return None if index == self.config.webhook.get('worker', 0) else workers[index]
+
+    async def _forward(self, worker: str, data: dict) -> web.Response:
+        # Telegram gets the answer of the worker and delivers the update again on an error
+        headers = {FORWARDED_HEADER: "1", "X-Telegram-Bot-Api-Secret-Token": self.config.webhook['secret_token']}
+        metrics.count("forwarded_updates_total")
+        try:
+            async with self.forward_session.post(worker, json=data, headers=headers) as response:
+                return web.Response(status=response.status)
+        except (ClientError, asyncio.TimeoutError):
+            return web.Response(status=502)
 
     def _isUser(self, update: Update) -> bool:
-        userId = str(update.message.from_user.id)
-        for user in self.config.users:
-            if user.id == userId:
-                return True
-        return False
+        return str(update.effective_user.id) in self.config.users
     
     def userById(self, update: Update) -> User:
-        for user in self.config.users:
-            userId = str(update.message.from_user.id)
-            if user.id == userId:
-                return user
-        return None
+        return self.config.users.get(str(update.effective_user.id))
+
+    def _trans(self, update: Update, token: str) -> str:
+        # text in the language of the user, unknown users get the language of their Telegram client
+        user = self.userById(update)
+        if user:
+            return self.lang.trans(token, user.lang())
+        return self.lang.trans(token, update.effective_user.language_code)
+
+    def _keepResident(self, user: User) -> None:
+        # the data of the users seen last stays in memory, the others are unloaded once
+        # there are more than max_resident_users. Users with unsaved changes stay.
+        self.resident[user.id] = user
+        self.resident.move_to_end(user.id)
+        limit = self.config.max_resident_users
+        if not limit or len(self.resident) <= limit:
+            return
+        for user_id, resident in list(self.resident.items()):
+            if len(self.resident) <= limit:
+                break
+            if resident is user or resident.changes:
+                continue
+            if self.config.storage.isSaving(resident):
+                continue
+            resident.unload()
+            del self.resident[user_id]
+
+    async def _watchConfig(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.config_reload_interval)
+            if self.config.reload():
+                self.openai_api.catalog.models = None # the list of models may have changed
+                for user_id in list(self.resident):
+                    if user_id not in self.config.users:
+                        del self.resident[user_id]
+
+    async def authorize(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.effective_message is not None and update.effective_message.date is not None:
+            # time from sending the message in Telegram until the bot handles it
+            metrics.observe("update_latency_seconds", max(0.0, time.time() - update.effective_message.date.timestamp()))
+        if update.effective_user is not None and self._isUser(update):
+            self._keepResident(self.userById(update))
+            await self._loadUser(self.userById(update))
+            return
+        # updates without a sender (e.g. channel posts) are stopped without an answer
+        if update.effective_message is not None and update.effective_user is not None:
+            await self._send(lambda: update.effective_message.reply_text(self._trans(update, "notInUserList")))
+        raise ApplicationHandlerStop
 
 # -------------------------------------------------------------------------------------
 
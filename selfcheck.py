@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Regression checks of the parts of the bot which are hard to see going wrong in
+# use: every storage backend has to give back what was saved, also after a journal
+# compaction and after a failed write, and the request scheduler has to serve the
+# waiting users in turn. Runs in a temporary
+# directory, without Telegram and OpenAI. The redis backend needs fakeredis
+# ("pip3 install fakeredis"), without it the redis checks are skipped.
+#
+# python3 selfcheck.py            (exit code 1 if a check failed)
+
+import os
+import sys
+import asyncio
+import tempfile
+import traceback
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import chatgpt_bot
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+BACKENDS = ("json", "journal", "sqlite", "redis")
+
+# -------------------------------------------------------------------------------------
+
+def message(role: str, content: str) -> dict:
+    return {"role": role, "content": content, "tokens": 5}
+
+def contents(user: chatgpt_bot.User, topic: str) -> list:
+    return [entry['content'] for entry in user.historyOfTopic(topic)]
+
+def createStorage(backend: str, redis_server=None, compact_after: int = 1000):
+    # a new instance reads everything from disk (or the redis server) again
+    if backend == "redis":
+        storage = chatgpt_bot.RedisStorage("redis://localhost:6379/0", "selfcheck")
+        storage.db = fakeredis.FakeRedis(server=redis_server, decode_responses=True)
+        return storage
+    return chatgpt_bot.createStorage(backend, compact_after, "", "")
+
+def createWriteBehind(storage) -> chatgpt_bot.WriteBehind:
+    # as used by the bot with "storage_flush_interval": 0, flush() writes the saved users
+    return chatgpt_bot.WriteBehind(storage, 0, 100)
+
+def createUser(storage) -> chatgpt_bot.User:
+    return chatgpt_bot.User("check", 1, "./chats/topics_check.json", 10, "en", storage)
+
+def check(condition: bool, text: str) -> None:
+    if not condition:
+        raise AssertionError(text)
+
+# -------------------------------------------------------------------------------------
+
+async def checkRoundTrip(backend: str, redis_server) -> None:
+    # all kinds of changes, saved by one instance and read back by another
+    storage = createWriteBehind(createStorage(backend, redis_server))
+    user = createUser(storage)
+    for topic in ("first", "second", "gone"):
+        user.addTopic(topic)
+    user.setCurrentTopic("second")
+    user.updateHistory("first", [message("user", "q1"), message("assistant", "a1")])
+    user.updateHistory("first", [message("user", "q2"), message("assistant", "a2")])
+    user.updateHistory("first", [message("user", "q3"), message("assistant", "a3")])
+    user.updateHistory("gone", [message("user", "x"), message("assistant", "y")])
+    user.summarizeHistory("first", 2, message("system", "summary of q1"))
+    user.setModel("gpt-4")
+    user.setModel("gpt-4-32k", "second")
+    user.deleteTopic("gone")
+    user.save()
+    await storage.flush()
+    if backend == "sqlite":
+        storage.storage.db.close()
+
+    loaded = createUser(createStorage(backend, redis_server))
+    check(loaded.topics() == ["first", "second"], "topics {}".format(loaded.topics()))
+    check(loaded.data['current_topic'] == "second", "current topic {}".format(loaded.data['current_topic']))
+    check(contents(loaded, "first") == ["q2", "a2", "q3", "a3"], "history {}".format(contents(loaded, "first")))
+    check(loaded.summaryOfTopic("first")['content'] == "summary of q1", "summary {}".format(loaded.summaryOfTopic("first")))
+    check(loaded.modelOf("second", "default") == "gpt-4-32k", "topic model {}".format(loaded.modelOf("second", "default")))
+    check(loaded.modelOf("first", "default") == "gpt-4", "user model {}".format(loaded.modelOf("first", "default")))
+
+async def checkCompaction(backend: str, redis_server) -> None:
+    # a compaction while a change is not saved yet (as the trim _chat records before the
+    # request) must not put that change into the snapshot and the next journal
+    storage = createWriteBehind(createStorage(backend, redis_server, compact_after=3))
+    user = createUser(storage)
+    user.addTopic("topic")
+    for index in range(3):
+        user.updateHistory("topic", [message("user", "q{}".format(index)), message("assistant", "a{}".format(index))])
+        user.save()
+    user.trimHistory("topic", 20) # q0 and a0 are dropped, not saved yet
+    await storage.flush()
+    user.updateHistory("topic", [message("user", "q3"), message("assistant", "a3")])
+    user.save()
+    await storage.flush()
+    expected = ["q1", "a1", "q2", "a2", "q3", "a3"]
+    check(contents(user, "topic") == expected, "in memory {}".format(contents(user, "topic")))
+    loaded = createUser(createStorage(backend, redis_server))
+    check(contents(loaded, "topic") == expected, "reloaded {}".format(contents(loaded, "topic")))
+
+async def checkFailedWrite(backend: str, redis_server, fail_snapshot: bool) -> None:
+    # the changes of a failed flush are written with the next one, in their order
+    storage = createWriteBehind(createStorage(backend, redis_server, compact_after=2 if fail_snapshot else 1000))
+    user = createUser(storage)
+    user.addTopic("topic")
+    user.save()
+    await storage.flush()
+    for index in range(2):
+        user.updateHistory("topic", [message("user", "q{}".format(index)), message("assistant", "a{}".format(index))])
+        user.save()
+
+    def fail(*arguments):
+        raise OSError("disk full")
+    commit, write = storage.storage.commit, chatgpt_bot._writeJSON
+    if fail_snapshot:
+        chatgpt_bot._writeJSON = fail
+    else:
+        storage.storage.commit = fail
+    try:
+        await storage.flush()
+    finally:
+        storage.storage.commit, chatgpt_bot._writeJSON = commit, write
+    check(user.name in storage.pending, "the failed changes are not queued again")
+
+    user.updateHistory("topic", [message("user", "q2"), message("assistant", "a2")])
+    user.save()
+    await storage.flush()
+    check(not storage.pending, "changes left after the second flush")
+    loaded = createUser(createStorage(backend, redis_server))
+    expected = ["q0", "a0", "q1", "a1", "q2", "a2"]
+    check(contents(loaded, "topic") == expected, "reloaded {}".format(contents(loaded, "topic")))
+
+async def checkRoundRobin() -> None:
+    # one user with many waiting requests must not hold back a user with one
+    scheduler = chatgpt_bot.RequestScheduler({"global": {"requests_per_minute": 6000}})
+    scheduler.global_buckets[0].level = 0 # used up, every request waits 10 ms
+    served = []
+    async def request(user_id: str, name: str) -> None:
+        await scheduler.acquire(user_id, 0)
+        served.append(name)
+    tasks = [asyncio.create_task(request("a", name)) for name in ("a1", "a2", "a3")]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(request("b", "b1")))
+    await asyncio.sleep(0)
+    check(scheduler.position("b") == 2, "position of b {}".format(scheduler.position("b")))
+    await asyncio.wait_for(asyncio.gather(*tasks), 5)
+    await scheduler.stop()
+    check(served == ["a1", "b1", "a2", "a3"], "served {}".format(served))
+
+# -------------------------------------------------------------------------------------
+
+def redisServer():
+    # every check gets an empty redis server, like the empty chats directory
+    return fakeredis.FakeServer() if fakeredis else None
+
+def checks():
+    # (name, function, arguments) of all checks
+    for backend in BACKENDS:
+        yield "round trip {}".format(backend), checkRoundTrip, (backend, redisServer())
+    yield "journal compaction with unsaved changes", checkCompaction, ("journal", None)
+    for backend in BACKENDS:
+        yield "failed write {}".format(backend), checkFailedWrite, (backend, redisServer(), False)
+    yield "failed journal snapshot", checkFailedWrite, ("journal", None, True)
+    yield "scheduler round robin", checkRoundRobin, ()
+
+def run() -> int:
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for name, function, arguments in checks():
+            if "redis" in name and fakeredis is None:
+                print("SKIP {} (pip3 install fakeredis)".format(name))
+                continue
+            # every check starts with an empty chats directory
+            os.chdir(tempfile.mkdtemp(dir=directory))
+            os.makedirs("chats")
+            try:
+                result = function(*arguments)
+                if asyncio.iscoroutine(result):
+                    asyncio.run(result)
+                print("OK   {}".format(name))
+            except Exception:
+                failed += 1
+                print("FAIL {}".format(name))
+                traceback.print_exc()
+        os.chdir(BASE_DIR)
+    print("{} failed".format(failed) if failed else "all checks passed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(run())